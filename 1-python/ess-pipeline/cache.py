@@ -0,0 +1,153 @@
+import functools
+import hashlib
+import inspect
+import json
+import pathlib
+import types
+
+import numpy as np
+
+from neutron_batch import NeutronBatch
+
+
+def _describe(value) -> str:
+    """Text that changes whenever a stage argument changes, used for the cache key."""
+
+    if isinstance(value, np.random.Generator):
+        raise TypeError("A Generator has hidden state, pass a seed to use the cache.")
+    if isinstance(value, NeutronBatch) or (isinstance(value, dict) and "x" in value):
+        batch = NeutronBatch.from_dict(value)
+        digest = hashlib.blake2b(np.ascontiguousarray(batch.data).tobytes()).hexdigest()
+        return f"events({batch.columns}, {digest})"
+    if isinstance(value, np.ndarray):
+        return f"array({value.shape}, {hashlib.blake2b(value.tobytes()).hexdigest()})"
+    if isinstance(value, functools.partial):
+        # Models from `physics` are partials, keyed on the function and its parameters
+        arguments = [_describe(arg) for arg in value.args]
+        keywords = {key: _describe(arg) for key, arg in sorted(value.keywords.items())}
+        return f"partial({_describe(value.func)}, {arguments}, {keywords})"
+    if isinstance(value, (types.BuiltinFunctionType, np.ufunc)):
+        return f"{type(value).__name__}({value.__name__})"
+    if isinstance(value, types.FunctionType):
+        return _describe_function(value)
+    if callable(value):
+        raise TypeError(f"Can not tell when {value!r} changes, it is not cached.")
+    return repr(value)
+
+
+def _describe_function(function) -> str:
+    """Text that changes with the code of `function` and the values it uses."""
+
+    # Constants and defaults are part of the code, as in `lambda n: 0.1 * n`,
+    # closures keep their values in the cells
+    values = [_describe(cell.cell_contents) for cell in function.__closure__ or ()]
+    values += [_describe(default) for default in function.__defaults__ or ()]
+    values += [
+        f"{key}={_describe(default)}"
+        for key, default in sorted((function.__kwdefaults__ or {}).items())
+    ]
+    # and plain values of the global variables it reads, e.g. in a notebook
+    for name in _global_names(function.__code__):
+        value = function.__globals__.get(name)
+        if isinstance(value, (bool, int, float, complex, str, tuple, np.ndarray)):
+            values.append(f"{name}={_describe(value)}")
+
+    # The module source picks up changes to the helper functions it calls
+    digest = hashlib.blake2b(_code_text(function.__code__).encode())
+    digest.update(_module_source(function).encode())
+    return f"{function.__module__}.{function.__qualname__}({', '.join(values)}, {digest.hexdigest()})"
+
+
+def _code_text(code) -> str:
+    # Bytecode, constants and names, not the file name or line numbers, which
+    # change between notebook sessions
+    consts = [_code_text(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts]
+    return f"{code.co_code.hex()}, {consts}, {code.co_names}"
+
+
+def _global_names(code) -> set:
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _module_source(value) -> str:
+    """Source code of the module defining `value`, empty for built-ins."""
+
+    try:
+        return inspect.getsource(inspect.getmodule(value))
+    except (TypeError, OSError):
+        return ""
+
+
+def cache_key(stage, args, kwargs) -> str:
+    """Hash of the stage source code, its inputs and its parameters."""
+
+    description = {
+        "stage": f"{stage.__module__}.{stage.__qualname__}",
+        # The whole module, so changes to helper functions are picked up too,
+        # and the event container every stage builds its output with
+        "source": _module_source(stage) + _module_source(NeutronBatch),
+        "args": [_describe(arg) for arg in args],
+        "kwargs": {key: _describe(value) for key, value in sorted(kwargs.items())},
+    }
+    text = json.dumps(description, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def cached(stage, cache_dir="pipeline_cache"):
+    """Wrap a stage so that its output is stored on disk and reloaded on later runs.
+
+    The output is saved in `cache_dir` as a `.npy` file holding the columns and a
+    `.json` file with the column names and the "message". It is found again by a
+    key made from the source code of the stage's module and of `neutron_batch`,
+    the input events and the parameters, so changing any of them runs the stage
+    again. Function parameters are keyed on their code, the values they close
+    over and the source of their module. Reloaded columns are
+    memory-mapped copy-on-write: they are read from disk when used and changes to
+    them are not written back.
+
+    The stage has to return events. Stages called with a `numpy.random.Generator`
+    or with callables other than functions, their `functools.partial`s and
+    built-ins are not cached, pass a seed instead of a Generator. A stage called without any seed is
+    reloaded with the random output of its first run.
+
+        neutrons = cached(target)(protons, rng=2)
+    """
+
+    cache_dir = pathlib.Path(cache_dir)
+
+    @functools.wraps(stage)
+    def wrapper(*args, **kwargs):
+        try:
+            key = cache_key(stage, args, kwargs)
+        except TypeError:
+            return stage(*args, **kwargs)
+
+        base = cache_dir / f"{stage.__name__}-{key[:16]}"
+        data_file = base.with_suffix(".npy")
+        info_file = base.with_suffix(".json")
+
+        if data_file.exists() and info_file.exists():
+            info = json.loads(info_file.read_text())
+            data = np.load(data_file, mmap_mode="c")
+            result = NeutronBatch.from_array(data, info["columns"])
+            result.metadata.update(info["metadata"])
+            return result
+
+        result = NeutronBatch.from_dict(stage(*args, **kwargs))
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        np.save(data_file, np.ascontiguousarray(result.data))
+        metadata = {
+            key: value for key, value in result.metadata.items() if isinstance(value, str)
+        }
+        info_file.write_text(
+            json.dumps({"columns": list(result.columns), "metadata": metadata})
+        )
+
+        return result
+
+    return wrapper
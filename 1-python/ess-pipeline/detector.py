@@ -2,31 +2,50 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 
-def record_events(neutrons: dict, nx=100, ny=100, bins=50) -> np.ndarray:
+def record_events(
+    neutrons: dict,
+    nx=100,
+    ny=100,
+    bins=50,
+    energy_range=(0.0, 100.0),
+    weights: np.ndarray = None,
+) -> np.ndarray:
     """Turn neutron positions into detector pixels.
     Also make a histogram of the neutron energies/wavelengths.
+
+    Each event counts with its entry in `weights`, by default the "weight" of
+    the events if they have one, and otherwise 1.
     """
 
+    if weights is None and "weight" in neutrons:
+        weights = neutrons["weight"]
+
     detector_width = 10.0  # what is the unit?
     detector_height = 10.0
 
-    image = np.zeros((nx, ny))
-    spectrum = np.zeros(bins)
+    # Convert x/y coordinates into pixel indices for all events at once.
+    x_pixel = np.floor((neutrons["x"] + detector_width / 2) / detector_width * nx).astype(int)
+    y_pixel = np.floor((neutrons["y"] + detector_height / 2) / detector_height * ny).astype(int)
+
+    # Keep only events that hit the detector.
+    on_detector = (0 <= x_pixel) & (x_pixel < nx) & (0 <= y_pixel) & (y_pixel < ny)
+
+    # Energy bin of each event, same idea as for the pixels.
+    e_min, e_max = energy_range
+    e_bin = np.floor((neutrons["energy"] - e_min) / (e_max - e_min) * bins).astype(int)
+    in_range = on_detector & (0 <= e_bin) & (e_bin < bins)
 
-    for x, y in zip(neutrons["x"], neutrons["y"]):
-        # Convert x/y coordinates into pixel indices.
-        x_pixel = int((x + detector_width / 2) / detector_width * nx)
-        y_pixel = int((y + detector_height / 2) / detector_height * ny)
+    image_weights = None if weights is None else weights[on_detector]
+    spectrum_weights = None if weights is None else weights[in_range]
 
-        # Keep only events that hit the detector.
-        if 0 <= x_pixel < nx and 0 <= y_pixel < ny:
-            image[x_pixel, y_pixel] += 1
+    # Flattened pixel index -> counts per pixel in a single np.bincount call.
+    pixel = x_pixel[on_detector] * ny + y_pixel[on_detector]
+    image = np.bincount(pixel, weights=image_weights, minlength=nx * ny).reshape(nx, ny)
+    spectrum = np.bincount(e_bin[in_range], weights=spectrum_weights, minlength=bins)
 
-    # TODO 1: Can the performance be improved by using numpy?
-    # TODO 2: Implement the wavelength/energy spectrum calculation.
-    # TODO 3: Can we think about resolution effects?
+    # TODO: Can we think about resolution effects?
 
-    return image, spectrum
+    return image.astype(float), spectrum.astype(float)
 
 
 def plot(image: np.ndarray, spectrum: np.ndarray) -> plt.Figure:
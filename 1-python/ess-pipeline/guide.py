@@ -1,57 +1,83 @@
 import numpy as np
 
+import physics
+from neutron_batch import NeutronBatch
 
-def transport(neutrons: dict) -> dict:
-    """Transport neutrons through the neutron guide."""
-
-    n = len(neutrons["x"])
-
-    transmission = 0.8  # Just a plain transmission fraction
-
-    x = []
-    y = []
-    z = []
-    vx = []
-    vy = []
-    vz = []
-    energy = []
-    time = []
-
-    for i in range(n):
-        survives = np.random.random() < transmission
-        if survives:
-            x.append(neutrons["x"][i])
-            y.append(neutrons["y"][i])
-            z.append(neutrons["z"][i])
-            energy.append(neutrons["energy"][i])
-            vx.append(neutrons["vx"][i])
-            vy.append(neutrons["vy"][i])
-            vz.append(neutrons["vz"][i])
-            time.append(neutrons["time"][i])
-
-    # TODO 1: some variables could be updated during transport (e.g. position, time, energy, etc.)
-    # TODO 2: how could the transmission be made more realistic? (e.g. energy-dependent, angle-dependent, etc.)
-    # TODO 3: is there room for optimization here? (e.g. using numpy arrays instead of lists)
-
-    return {
-        "x": np.array(x),
-        "y": np.array(y),
-        "z": np.array(z),
-        "vx": np.array(vx),
-        "vy": np.array(vy),
-        "vz": np.array(vz),
-        "energy": np.array(energy),
-        "time": np.array(time),
-    }
-
-
-def neutron_guide(neutrons: dict) -> dict:
+
+def transport(
+    neutrons: dict,
+    rng=None,
+    guide_length: float = None,
+    transmission=0.8,
+    weighted: bool = False,
+) -> NeutronBatch:
+    """Transport neutrons through the neutron guide.
+
+    If `guide_length` [m] is given, the neutrons are moved to the end of the guide
+    and their time [s] is increased by the time of flight along it.
+    `transmission` is a plain transmission fraction or a model from `physics`,
+    e.g. `physics.supermirror(m=2)`, giving the probability for every neutron.
+    If `weighted`, no neutron is lost at random, the transmission probability
+    is multiplied into the weight instead.
+    """
+
+    rng = np.random.default_rng(rng)
+
+    neutrons = NeutronBatch.from_dict(neutrons)
+    n = neutrons.n_events
+
+    if callable(transmission):
+        probability = transmission(neutrons)
+    else:
+        probability = transmission  # Just a plain transmission fraction
+
+    if weighted:
+        survives = np.ones(n, dtype=bool)
+    else:
+        # One random number per neutron, drawn all at once
+        survives = rng.random(n) < probability
+
+    if guide_length is not None:
+        # Neutrons moving away from the guide never reach its end
+        survives &= neutrons["vz"] > 0
+
+    # The survivors share the columns of the input, nothing is copied here
+    out = neutrons.select(survives)
+
+    if guide_length is not None:
+        # The walls keep the neutrons inside, so only z and the time change
+        out["z"] = out["z"] + guide_length
+        # vx, vy, vz give the direction, the speed follows from the energy
+        vz = out["vz"] / np.sqrt(out["vx"] ** 2 + out["vy"] ** 2 + out["vz"] ** 2)
+        out["time"] = out["time"] + guide_length / (vz * physics.speed(out))
+
+    if weighted:
+        out["weight"] = out["weight"] * np.broadcast_to(probability, n)[survives]
+
+    return out
+
+
+def neutron_guide(
+    neutrons: dict,
+    rng=None,
+    guide_length: float = None,
+    transmission=0.8,
+    weighted: bool = False,
+) -> NeutronBatch:
     """Simulate transport through a neutron guide."""
 
-    to_sample = transport(neutrons)
+    to_sample = transport(
+        neutrons,
+        rng=rng,
+        guide_length=guide_length,
+        transmission=transmission,
+        weighted=weighted,
+    )
 
     to_sample["message"] = (
         f"Neutron guide: {len(to_sample['x'])} neutrons survived transport."
     )
+    if weighted:
+        to_sample["message"] += f" Total weight: {to_sample['weight'].sum():.1f}."
 
     return to_sample
@@ -0,0 +1,104 @@
+import json
+import time
+import tracemalloc
+
+
+def count_events(data) -> int:
+    """Number of events in a stage input or output, None if it holds no events."""
+
+    if hasattr(data, "n_events"):
+        return int(data.n_events)
+    if isinstance(data, dict) and "x" in data:
+        return len(data["x"])
+    return None
+
+
+class PipelineStats:
+    """Record wall time, event counts and peak memory of pipeline stages.
+
+    Run each stage through `measure`, e.g.
+
+        stats = PipelineStats()
+        protons = stats.measure("source_and_accelerator", source_and_accelerator)
+        neutrons = stats.measure("target", target, protons)
+        print(stats.table())
+
+    With `memory=True` the peak memory is recorded as well: the largest amount
+    of memory allocated while the stage ran, as seen by `tracemalloc` (which
+    includes numpy arrays). Tracing slows down Python code considerably, so the
+    times and rates are then only useful for comparing stages with each other.
+    If the caller is already tracing, its peak is left alone and no peak is
+    recorded.
+    """
+
+    def __init__(self, memory: bool = False):
+        self.memory = memory
+        self.records = []
+
+    def measure(self, name: str, stage, *args, **kwargs):
+        """Call `stage(*args, **kwargs)`, record its statistics and return its result."""
+
+        events_in = count_events(args[0]) if args else None
+
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        result = stage(*args, **kwargs)
+        wall_time = time.perf_counter() - start
+
+        peak_memory = None
+        if tracing:
+            peak_memory = tracemalloc.get_traced_memory()[1] - memory_before
+            tracemalloc.stop()
+
+        events_out = count_events(result)
+        events = max(n for n in (events_in, events_out, 0) if n is not None)
+
+        self.records.append(
+            {
+                "stage": name,
+                "wall_time": wall_time,
+                "events_in": events_in,
+                "events_out": events_out,
+                "events_per_second": events / wall_time if wall_time > 0 else None,
+                "peak_memory_mb": None if peak_memory is None else peak_memory / 1e6,
+            }
+        )
+
+        return result
+
+    def table(self) -> str:
+        """Format the records as a text table."""
+
+        header = (
+            f"{'stage':<24}{'time [s]':>12}{'events in':>12}{'events out':>12}"
+            f"{'events/s':>14}{'peak [MB]':>12}"
+        )
+        lines = [header, "-" * len(header)]
+
+        def fmt(value, spec):
+            return "-" if value is None else format(value, spec)
+
+        for record in self.records:
+            lines.append(
+                f"{record['stage']:<24}"
+                f"{record['wall_time']:>12.4f}"
+                f"{fmt(record['events_in'], '>12d'):>12}"
+                f"{fmt(record['events_out'], '>12d'):>12}"
+                f"{fmt(record['events_per_second'], '>14.3g'):>14}"
+                f"{fmt(record['peak_memory_mb'], '>12.2f'):>12}"
+            )
+
+        return "\n".join(lines)
+
+    def to_json(self, filename: str = None) -> str:
+        """Return the records as JSON, and write them to `filename` if given."""
+
+        text = json.dumps(self.records, indent=2)
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(text)
+        return text
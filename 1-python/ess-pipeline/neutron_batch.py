@@ -0,0 +1,145 @@
+from collections.abc import MutableMapping
+
+import numpy as np
+
+COLUMNS = ("x", "y", "z", "vx", "vy", "vz", "energy", "time", "weight")
+
+
+class NeutronBatch(MutableMapping):
+    """Columnar container for the events passed between the pipeline stages.
+
+    All columns live in one contiguous (n_columns, n_events) array and are read
+    and written by name like the entries of a dict, e.g. `batch["x"]`. Any other
+    entry, such as the stage "message", is kept in a plain dict next to it.
+    All columns start at zero, except "weight" which starts at one.
+
+    `select` returns a batch sharing the same array with a selection index, so
+    filtering copies nothing until a column is read. `compact` instead moves the
+    selected events to the front of the array in place.
+    """
+
+    def __init__(self, n_events: int, columns=COLUMNS):
+        self.columns = tuple(columns)
+        self._index = {name: i for i, name in enumerate(self.columns)}
+        self._data = np.zeros((len(self.columns), n_events))
+        if "weight" in self._index:
+            self._data[self._index["weight"]] = 1.0
+        self._size = n_events
+        self.selection = None
+        self.metadata = {}
+
+    @classmethod
+    def from_dict(cls, neutrons: dict, columns=COLUMNS) -> "NeutronBatch":
+        """Pack a dict of equally long arrays into a batch (batches are returned as they are)."""
+        if isinstance(neutrons, NeutronBatch):
+            return neutrons
+
+        batch = cls(len(neutrons[columns[0]]), columns)
+        for key, value in neutrons.items():
+            batch[key] = value
+        return batch
+
+    @classmethod
+    def from_array(cls, data: np.ndarray, columns=COLUMNS) -> "NeutronBatch":
+        """Wrap an existing (n_columns, n_events) array without copying it."""
+        batch = cls.__new__(cls)
+        batch.columns = tuple(columns)
+        batch._index = {name: i for i, name in enumerate(batch.columns)}
+        batch._data = data
+        batch._size = data.shape[1]
+        batch.selection = None
+        batch.metadata = {}
+        return batch
+
+    @classmethod
+    def concatenate(cls, batches) -> "NeutronBatch":
+        """Join the events of several batches with the same columns into a new batch."""
+        batches = [cls.from_dict(batch) for batch in batches]
+        columns = batches[0].columns
+        return cls.from_array(
+            np.concatenate([batch.data for batch in batches], axis=1), columns
+        )
+
+    @property
+    def data(self) -> np.ndarray:
+        """The (n_columns, n_events) array of the selected events."""
+        if self.selection is None:
+            return self._data[:, : self._size]
+        return self._data[:, self.selection]
+
+    @property
+    def n_events(self) -> int:
+        return self._size if self.selection is None else len(self.selection)
+
+    def __getitem__(self, key):
+        if key not in self._index:
+            return self.metadata[key]
+
+        column = self._data[self._index[key], : self._size]
+        if self.selection is None:
+            return column  # a view, so in-place operations update the batch
+        return column[self.selection]
+
+    def __setitem__(self, key, value):
+        if key not in self._index:
+            self.metadata[key] = value
+            return
+
+        if self.selection is not None:
+            # Writing to a selection must not change the batch it was selected from
+            self._materialize()
+        self._data[self._index[key], : self._size] = value
+
+    def __delitem__(self, key):
+        if key in self._index:
+            raise KeyError(f"Column '{key}' cannot be removed from a NeutronBatch.")
+        del self.metadata[key]
+
+    def __iter__(self):
+        yield from self.columns
+        yield from self.metadata
+
+    def __len__(self):
+        return len(self.columns) + len(self.metadata)
+
+    def select(self, mask: np.ndarray) -> "NeutronBatch":
+        """Batch with the events where `mask` is True, sharing the array of this batch."""
+        view = NeutronBatch.__new__(NeutronBatch)
+        view.columns = self.columns
+        view._index = self._index
+        view._data = self._data
+        view._size = self._size
+        index = np.flatnonzero(mask)
+        view.selection = index if self.selection is None else self.selection[index]
+        view.metadata = {}
+        return view
+
+    def compact(self, mask: np.ndarray = None) -> "NeutronBatch":
+        """Keep the events where `mask` is True by moving them to the front of the array.
+
+        This rearranges the array in place, so batches selected from this one
+        earlier must not be used afterwards. A selection is given its own array
+        first, so the batch it was selected from is not changed.
+        """
+        if self.selection is not None:
+            self._materialize()
+        keep = np.arange(self._size)
+        if mask is not None:
+            keep = keep[mask]
+
+        self._data[:, : len(keep)] = self._data[:, keep]
+        self._size = len(keep)
+        self.selection = None
+        return self
+
+    def copy(self) -> "NeutronBatch":
+        batch = NeutronBatch(self.n_events, self.columns)
+        batch._data[:] = self.data
+        batch.metadata = dict(self.metadata)
+        return batch
+
+    def _materialize(self):
+        # Give a selection its own array, holding only the selected events
+        self._data = self._data[:, self.selection]
+        self._size = self._data.shape[1]
+        self.selection = None
@@ -0,0 +1,100 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from neutron_batch import NeutronBatch
+
+
+def _process_shard(data, output, columns, stage, seed, kwargs):
+    shard = NeutronBatch.from_array(data, columns)
+    result = NeutronBatch.from_dict(stage(shard, rng=seed, **kwargs), columns)
+    if result.n_events > output.shape[1]:
+        raise ValueError("A stage run in parallel can not return more events than it is given.")
+
+    # Write the output into the shard's part of the shared output block
+    output[:, : result.n_events] = result.data
+    return result.n_events
+
+
+def _run_shard(input_name, output_name, shape, columns, start, stop, stage, seed, kwargs):
+    # Runs in a worker process: attach to the shared blocks and process one shard of them
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    data = np.ndarray(shape, dtype=float, buffer=input_memory.buf)
+    output = np.ndarray(shape, dtype=float, buffer=output_memory.buf)
+    n_events = _process_shard(
+        data[:, start:stop], output[:, start:stop], columns, stage, seed, kwargs
+    )
+
+    # All views of the shared blocks have to be gone before they can be closed
+    del data, output
+    input_memory.close()
+    output_memory.close()
+    return n_events
+
+
+def run_stage_parallel(
+    stage, neutrons: dict, processes: int = None, seed=None, **kwargs
+) -> NeutronBatch:
+    """Run a pipeline stage over shards of the events in a pool of processes.
+
+    `stage` has to take the events and an `rng` argument and return at most as
+    many events as it is given, like `make_neutrons`, `transport` or
+    `interact_with_sample`. The input columns are placed once in shared memory
+    and every worker writes its output into its shard of a second shared block,
+    so only the shard boundaries and event counts go between the processes.
+    Each shard gets its own random stream spawned from `seed`, and the outputs
+    are concatenated in shard order.
+    """
+
+    if processes is None:
+        processes = os.cpu_count()
+
+    neutrons = NeutronBatch.from_dict(neutrons)
+    data = neutrons.data
+    bounds = np.linspace(0, data.shape[1], processes + 1).astype(int)
+    seeds = np.random.SeedSequence(seed).spawn(processes)
+
+    input_memory = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    output_memory = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    try:
+        shared_input = np.ndarray(data.shape, dtype=float, buffer=input_memory.buf)
+        shared_input[:] = data
+        shared_output = np.ndarray(data.shape, dtype=float, buffer=output_memory.buf)
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [
+                executor.submit(
+                    _run_shard,
+                    input_memory.name,
+                    output_memory.name,
+                    data.shape,
+                    neutrons.columns,
+                    bounds[i],
+                    bounds[i + 1],
+                    stage,
+                    seeds[i],
+                    kwargs,
+                )
+                for i in range(processes)
+            ]
+            counts = [future.result() for future in futures]
+
+        # Copy the filled part of each shard out of the shared block before it is freed
+        output = np.concatenate(
+            [
+                shared_output[:, bounds[i] : bounds[i] + counts[i]]
+                for i in range(processes)
+            ],
+            axis=1,
+        )
+        del shared_input, shared_output
+    finally:
+        input_memory.close()
+        input_memory.unlink()
+        output_memory.close()
+        output_memory.unlink()
+
+    return NeutronBatch.from_array(output, neutrons.columns)
@@ -0,0 +1,155 @@
+"""Vectorized transmission and scattering models for the guide and sample stages.
+
+Transmission models are functions `model(neutrons) -> probability` returning the
+transmission probability of every event. Scattering models are functions
+`model(neutrons, rng) -> (vx, vy, vz, scattered)` returning new velocities and a
+mask of the events that could scatter. The functions below create such models
+as `functools.partial`s of module-level functions, so that they can be sent to
+the worker processes of `parallel` and are keyed by their parameters in `cache`.
+
+Energies are taken to be in meV and wavelengths are in Å.
+"""
+
+import functools
+
+import numpy as np
+
+
+def wavelength(neutrons: dict) -> np.ndarray:
+    """Neutron wavelength in Å from the energy in meV."""
+
+    return 9.045 / np.sqrt(neutrons["energy"])
+
+
+def speed(neutrons: dict) -> np.ndarray:
+    """Neutron speed in m/s from the energy in meV."""
+
+    return 437.4 * np.sqrt(neutrons["energy"])
+
+
+def divergence(neutrons: dict) -> np.ndarray:
+    """Angle between the velocity and the beam (z) direction in radians."""
+
+    transverse = np.hypot(neutrons["vx"], neutrons["vy"])
+    return np.arctan2(transverse, neutrons["vz"])
+
+
+def flat(probability: float):
+    """The same transmission probability for every event."""
+
+    return functools.partial(_flat, probability=probability)
+
+
+def _flat(neutrons, probability):
+    return np.full(len(neutrons["energy"]), probability)
+
+
+def supermirror(m=2.0, R0=0.99, Qc=0.0219, alpha=6.07, W=0.003):
+    """Supermirror reflectivity for one reflection at the divergence angle.
+
+    Uses the reflectivity parametrisation of the McStas guide components: full
+    reflectivity R0 up to the critical scattering vector Qc of nickel, then a
+    linear decrease with slope alpha until the cut-off at m * Qc of width W.
+    Neutrons moving backwards (vz <= 0) are not transmitted.
+    """
+
+    return functools.partial(_supermirror, m=m, R0=R0, Qc=Qc, alpha=alpha, W=W)
+
+
+def _supermirror(neutrons, m, R0, Qc, alpha, W):
+    q = 4 * np.pi * np.sin(divergence(neutrons)) / wavelength(neutrons)
+    reflectivity = np.where(
+        q <= Qc,
+        R0,
+        0.5 * R0 * (1 - np.tanh((q - m * Qc) / W)) * (1 - alpha * (q - Qc)),
+    )
+    return np.where(neutrons["vz"] > 0, np.clip(reflectivity, 0, 1), 0)
+
+
+def beer_lambert(thickness=1.0, absorption=0.1, scattering=0.0):
+    """Beer-Lambert attenuation through a slab of `thickness` [cm].
+
+    `absorption` is the absorption coefficient at 1.798 Å and scales linearly
+    with wavelength, `scattering` is wavelength independent, both in 1/cm.
+    """
+
+    return functools.partial(
+        _beer_lambert, thickness=thickness, absorption=absorption, scattering=scattering
+    )
+
+
+def _beer_lambert(neutrons, thickness, absorption, scattering):
+    attenuation = absorption * wavelength(neutrons) / 1.798 + scattering
+    return np.exp(-attenuation * thickness)
+
+
+def _directions_on_cone(vx, vy, vz, opening_angle, phi):
+    # Rotate each velocity by opening_angle around itself at azimuth phi, keeping the speed
+    speed = np.sqrt(vx**2 + vy**2 + vz**2)
+    u = np.stack((vx, vy, vz)) / speed
+
+    # Any vector not parallel to u gives the two perpendicular directions
+    helper = np.zeros_like(u)
+    use_x = np.abs(u[2]) > 0.9
+    helper[0, use_x] = 1
+    helper[2, ~use_x] = 1
+    e1 = np.cross(u, helper, axis=0)
+    e1 /= np.linalg.norm(e1, axis=0)
+    e2 = np.cross(u, e1, axis=0)
+
+    direction = np.cos(opening_angle) * u + np.sin(opening_angle) * (
+        np.cos(phi) * e1 + np.sin(phi) * e2
+    )
+    return direction * speed
+
+
+def isotropic_scattering():
+    """Scatter into a direction uniform on the sphere, keeping the speed."""
+
+    return functools.partial(_isotropic_scattering)
+
+
+def _isotropic_scattering(neutrons, rng):
+    speed = np.sqrt(neutrons["vx"] ** 2 + neutrons["vy"] ** 2 + neutrons["vz"] ** 2)
+    n = len(speed)
+    cos_theta = rng.uniform(-1, 1, n)
+    sin_theta = np.sqrt(1 - cos_theta**2)
+    phi = rng.uniform(0, 2 * np.pi, n)
+    vx = speed * sin_theta * np.cos(phi)
+    vy = speed * sin_theta * np.sin(phi)
+    vz = speed * cos_theta
+    return vx, vy, vz, np.ones(n, dtype=bool)
+
+
+def bragg_scattering(d_spacing=(3.135, 1.920, 1.637)):
+    """Powder (Debye-Scherrer) scattering from the given d-spacings in Å.
+
+    Each event picks one of the reflections allowed by Bragg's law
+    (wavelength < 2 d) at random and is scattered onto its cone of opening
+    angle 2 theta. Events for which no reflection is allowed do not scatter.
+    The default d-spacings are the first reflections of silicon.
+    """
+
+    return functools.partial(_bragg_scattering, d_spacing=np.asarray(d_spacing, dtype=float))
+
+
+def _bragg_scattering(neutrons, rng, d_spacing):
+    lam = wavelength(neutrons)
+    n = len(lam)
+
+    # Choose uniformly among the allowed reflections of each event
+    allowed = lam[:, np.newaxis] < 2 * d_spacing
+    n_allowed = allowed.sum(axis=1)
+    scattered = n_allowed > 0
+    choice = np.floor(rng.random(n) * n_allowed).astype(int)
+    ranks = np.cumsum(allowed, axis=1) - 1
+    reflection = np.argmax(allowed & (ranks == choice[:, np.newaxis]), axis=1)
+
+    sin_theta = np.where(scattered, lam / (2 * d_spacing[reflection]), 0)
+    two_theta = 2 * np.arcsin(sin_theta)
+    phi = rng.uniform(0, 2 * np.pi, n)
+
+    vx, vy, vz = _directions_on_cone(
+        neutrons["vx"], neutrons["vy"], neutrons["vz"], two_theta, phi
+    )
+    return vx, vy, vz, scattered
@@ -1,32 +1,90 @@
 import numpy as np
 
+from neutron_batch import NeutronBatch
 
-def interact_with_sample(neutrons: dict) -> dict:
-    """Decide what happens to each neutron."""
 
-    n = len(neutrons["x"])
+def interact_with_sample(
+    neutrons: dict, rng=None, transmission=0.8, scattering=None, weighted: bool = False
+) -> NeutronBatch:
+    """Decide what happens to each neutron.
 
-    random_numbers = np.random.random(n)
+    `transmission` is a plain transmission fraction or a model from `physics`,
+    e.g. `physics.beer_lambert(thickness=0.5)`. Neutrons that are not transmitted
+    are lost, unless a `scattering` model such as `physics.bragg_scattering()`
+    is given, in which case they continue in their new direction.
+    If `weighted`, no neutron is lost at random: every neutron is transmitted
+    with its weight multiplied by the transmission probability, and with a
+    `scattering` model a scattered copy follows with the rest of the weight.
+    """
 
-    transmitted = random_numbers > 0.2
+    rng = np.random.default_rng(rng)
 
-    out = {}
-    for key in ("x", "y", "z", "vx", "vy", "vz", "energy", "time"):
-        # Select only the neutrons that pass through by indexing with the boolean array `transmitted`
-        out[key] = neutrons[key][transmitted]
+    neutrons = NeutronBatch.from_dict(neutrons)
+    n = neutrons.n_events
 
-    # TODO 1: add other interactions (e.g. scattering, inelastic process, etc.)
-    # TODO 2: make the probabilities depend on neutron energy, angle, etc.
-    # TODO 3: make the transmission/scattering pattern interesting to look at for the detector team
+    if callable(transmission):
+        probability = transmission(neutrons)
+    else:
+        probability = transmission
+
+    if weighted:
+        out = neutrons.copy()
+        out["weight"] = out["weight"] * probability
+        if scattering is None:
+            return out
+
+        # The scattered branch carries the weight that was not transmitted
+        vx, vy, vz, can_scatter = scattering(neutrons, rng)
+        scattered = neutrons.select(can_scatter).copy()
+        scattered["vx"] = vx[can_scatter]
+        scattered["vy"] = vy[can_scatter]
+        scattered["vz"] = vz[can_scatter]
+        not_transmitted = 1 - np.broadcast_to(probability, n)[can_scatter]
+        scattered["weight"] = scattered["weight"] * not_transmitted
+        return NeutronBatch.concatenate([out, scattered])
+
+    random_numbers = rng.random(n)
+
+    transmitted = random_numbers < probability
+
+    if scattering is None:
+        # Select only the neutrons that pass through with the boolean array `transmitted`
+        return neutrons.select(transmitted)
+
+    # The interacting neutrons scatter if the model allows it
+    interacting = np.flatnonzero(~transmitted)
+    vx, vy, vz, can_scatter = scattering(neutrons.select(~transmitted), rng)
+    scattered = np.zeros(n, dtype=bool)
+    scattered[interacting[can_scatter]] = True
+
+    # Copy the survivors, as the scattered ones get new velocities
+    keep = transmitted | scattered
+    out = neutrons.select(keep).copy()
+    changed = scattered[keep]
+    out["vx"][changed] = vx[can_scatter]
+    out["vy"][changed] = vy[can_scatter]
+    out["vz"][changed] = vz[can_scatter]
+
+    # TODO: make the transmission/scattering pattern interesting to look at for the detector team
 
     return out
 
 
-def sample(neutrons: dict) -> dict:
+def sample(
+    neutrons: dict, rng=None, transmission=0.8, scattering=None, weighted: bool = False
+) -> NeutronBatch:
 
-    after_sample = interact_with_sample(neutrons)
+    after_sample = interact_with_sample(
+        neutrons,
+        rng=rng,
+        transmission=transmission,
+        scattering=scattering,
+        weighted=weighted,
+    )
 
     after_sample["message"] = (
         f"Sample interaction: {len(after_sample['x'])} neutrons survived."
     )
+    if weighted:
+        after_sample["message"] += f" Total weight: {after_sample['weight'].sum():.1f}."
     return after_sample
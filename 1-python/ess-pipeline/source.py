@@ -1,29 +1,30 @@
 import numpy as np
 
+from neutron_batch import NeutronBatch
 
-def make_protons(n_protons: int = 100) -> dict:
+
+def make_protons(n_protons: int = 100, rng=None) -> NeutronBatch:
     """Create a bunch of protons at the source."""
 
+    rng = np.random.default_rng(rng)
+
     initial_energy = 1.0  # what is the unit?
     v = np.sqrt(2 * initial_energy)
 
-    protons = {
-        "x": np.random.normal(0, 1, n_protons),  # X is transverse to the beam direction
-        "y": np.random.normal(0, 1, n_protons),  # Y is up, opposite to gravity
-        "z": np.zeros(n_protons),  # Z is along the beam direction
-        "vx": np.zeros(n_protons),  # Velocity in X direction
-        "vy": np.zeros(n_protons),  # Velocity in Y direction
-        "vz": np.full(n_protons, fill_value=v),  # Velocity in Z direction
-        "energy": np.full(n_protons, fill_value=initial_energy),
-        "time": np.zeros(n_protons),
-    }
+    # All columns start at zero: z is along the beam direction, vx and vy are
+    # the transverse velocities, and the protons start at time 0.
+    protons = NeutronBatch(n_protons)
+    protons["x"] = rng.normal(0, 1, n_protons)  # X is transverse to the beam direction
+    protons["y"] = rng.normal(0, 1, n_protons)  # Y is up, opposite to gravity
+    protons["vz"] = v  # Velocity in Z direction
+    protons["energy"] = initial_energy
 
     # TODO: How could we make the initial proton distribution more realistic? (e.g. beam size, divergence, energy spread, etc.)
 
     return protons
 
 
-def accelerate(protons: dict) -> dict:
+def accelerate(protons: NeutronBatch) -> NeutronBatch:
     """Accelerate the proton beam."""
 
     protons["energy"] = np.full_like(protons["energy"], fill_value=1000.0)
@@ -33,8 +34,8 @@ def accelerate(protons: dict) -> dict:
     return protons
 
 
-def source_and_accelerator():
-    protons = make_protons(n_protons=10_000)
+def source_and_accelerator(rng=None):
+    protons = make_protons(n_protons=10_000, rng=rng)
     protons = accelerate(protons)
     protons["message"] = (
         f"Produced {len(protons['x'])} protons with energy {protons['energy'][0]}."
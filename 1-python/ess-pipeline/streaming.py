@@ -0,0 +1,87 @@
+import numpy as np
+
+from detector import plot, record_events
+from guide import transport
+from sample import interact_with_sample
+from source import accelerate, make_protons
+from target import make_neutrons
+
+
+def proton_chunks(n_protons: int, chunk_size: int, rng=None):
+    """Yield accelerated protons in chunks of at most `chunk_size`."""
+
+    rng = np.random.default_rng(rng)
+
+    for start in range(0, n_protons, chunk_size):
+        n = min(chunk_size, n_protons - start)
+        yield accelerate(make_protons(n_protons=n, rng=rng))
+
+
+def neutron_chunks(
+    n_protons: int,
+    chunk_size: int,
+    seed=None,
+    guide_length: float = None,
+    weighted: bool = False,
+):
+    """Push chunks of protons through target, guide and sample.
+
+    Yields the neutrons reaching the detector, one chunk at a time. Each stage
+    draws from its own random stream spawned from `seed`.
+    """
+
+    source_rng, target_rng, guide_rng, sample_rng = [
+        np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(4)
+    ]
+
+    for protons in proton_chunks(n_protons, chunk_size, rng=source_rng):
+        neutrons = make_neutrons(protons, rng=target_rng, weighted=weighted)
+        neutrons = transport(
+            neutrons, rng=guide_rng, guide_length=guide_length, weighted=weighted
+        )
+        yield interact_with_sample(neutrons, rng=sample_rng, weighted=weighted)
+
+
+def run_chunked(
+    n_protons: int = 10_000,
+    chunk_size: int = 100_000,
+    seed=None,
+    guide_length: float = None,
+    weighted: bool = False,
+    nx=100,
+    ny=100,
+    bins=50,
+) -> dict:
+    """Run the whole pipeline chunk by chunk.
+
+    Only one chunk of events is held in memory at a time, while the detector
+    image and spectrum are summed over all chunks. The result has the same
+    entries as the output of `detector.detector`.
+    """
+
+    image = np.zeros((nx, ny))
+    spectrum = np.zeros(bins)
+    n_detected = 0
+
+    for neutrons in neutron_chunks(
+        n_protons, chunk_size, seed, guide_length, weighted
+    ):
+        chunk_image, chunk_spectrum = record_events(neutrons, nx=nx, ny=ny, bins=bins)
+        image += chunk_image
+        spectrum += chunk_spectrum
+        n_detected += neutrons.n_events
+
+    results = {
+        "image": image,
+        "spectrum": spectrum,
+        "plot": plot(image, spectrum),
+    }
+
+    results["message"] = (
+        f"Chunked pipeline: {n_detected} neutrons detected from {n_protons} protons "
+        f"in chunks of {chunk_size}. "
+        f"Image shape: {image.shape}. "
+        f"Spectrum bins: {len(spectrum)}."
+    )
+
+    return results
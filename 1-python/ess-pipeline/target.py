@@ -1,59 +1,60 @@
 import numpy as np
 
+from neutron_batch import NeutronBatch
 
-def make_neutrons(protons: dict, probability: float = 0.1) -> dict:
-    """Convert some protons into neutrons."""
+
+def make_neutrons(
+    protons: dict, probability: float = 0.1, rng=None, weighted: bool = False
+) -> NeutronBatch:
+    """Convert some protons into neutrons.
+
+    If `weighted`, every proton produces a neutron and the `probability` is
+    multiplied into its weight instead, like the `p` weight of McStas events.
+    """
+
+    rng = np.random.default_rng(rng)
 
     n = len(protons["x"])
 
-    x = []
-    y = []
-    z = []
-    vx = []
-    vy = []
-    vz = []
-    energy = []
-    time = []
-
-    for i in range(n):
-        p = np.random.random() < probability
-        if p:
-            x.append(protons["x"][i])
-            y.append(protons["y"][i])
-            z.append(protons["z"][i])
-            e = np.random.uniform(1, 100)  # what is the unit?
-            energy.append(e)
-            v_x = np.random.uniform(-1, 1)
-            v_y = np.random.uniform(-1, 1)
-            v_z = np.random.uniform(-1, 1)
-            norm = np.sqrt(v_x**2 + v_y**2 + v_z**2)
-            vx.append(v_x / norm)
-            vy.append(v_y / norm)
-            vz.append(v_z / norm)
-            time.append(protons["time"][i])
+    # Decide for all protons at once which ones produce a neutron
+    if weighted:
+        produces_neutron = np.ones(n, dtype=bool)
+    else:
+        produces_neutron = rng.random(n) < probability
+    n_neutrons = np.count_nonzero(produces_neutron)
+
+    energy = rng.uniform(1, 100, n_neutrons)  # what is the unit?
+
+    # Directions uniform on the unit sphere: uniform cos(theta) and phi
+    cos_theta = rng.uniform(-1, 1, n_neutrons)
+    sin_theta = np.sqrt(1 - cos_theta**2)
+    phi = rng.uniform(0, 2 * np.pi, n_neutrons)
 
     # TODO 1: make neutron energy depend on proton energy
-    # TODO 2: is there room for optimization here? (e.g. using numpy arrays instead of lists)
-    # TODO 3: is there a better way to sample the neutron velocity direction than uniform in a cube?
-
-    return {
-        "x": np.array(x),
-        "y": np.array(y),
-        "z": np.array(z),
-        "vx": np.array(vx),
-        "vy": np.array(vy),
-        "vz": np.array(vz),
-        "energy": np.array(energy),
-        "time": np.array(time),
-    }
-
-
-def target(protons: dict) -> dict:
+
+    neutrons = NeutronBatch(n_neutrons)
+    for key in ("x", "y", "z", "time"):
+        neutrons[key] = protons[key][produces_neutron]
+    if "weight" in protons:
+        neutrons["weight"] = protons["weight"][produces_neutron]
+    if weighted:
+        neutrons["weight"] *= probability
+    neutrons["vx"] = sin_theta * np.cos(phi)
+    neutrons["vy"] = sin_theta * np.sin(phi)
+    neutrons["vz"] = cos_theta
+    neutrons["energy"] = energy
+
+    return neutrons
+
+
+def target(protons: dict, rng=None, weighted: bool = False) -> NeutronBatch:
     """Simulate neutron production in the target."""
 
-    neutrons = make_neutrons(protons)
+    neutrons = make_neutrons(protons, rng=rng, weighted=weighted)
     neutrons["message"] = (
         f"Target: {len(neutrons['x'])} neutrons produced from {len(protons['x'])} protons."
     )
+    if weighted:
+        neutrons["message"] += f" Total weight: {neutrons['weight'].sum():.1f}."
 
     return neutrons
@@ -1,75 +1,107 @@
+import warnings
+
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.stats import qmc
 from ipywidgets import widgets
 from IPython.display import display, clear_output
 
-# Function to update plots and estimate Pi
-def plot_points(square_side_length, circle_radius,n=100):
-    global points_inside_circle, total_points, estimates, estimate
-    global points_x_inside, points_y_inside, points_x_outside, points_y_outside
-
-    for _ in range(n):
-        x, y = np.random.rand(2)*square_side_length  # Random points x, y between 0 and 1
-        distance = np.sqrt((x-0.5*square_side_length)**2 + (y-0.5*square_side_length)**2)
-
-        total_points += 1
-
-        if distance <= circle_radius:
-            points_inside_circle += 1
-            points_x_inside.append(x)
-            points_y_inside.append(y)
-        else:
-            points_x_outside.append(x)
-            points_y_outside.append(y)
-
-        # area of circle = pi*circle_radius**2
-        # area of box = side_length**2
-        # estimate =
-
-        estimate = square_side_length**2/circle_radius**2 * points_inside_circle / total_points
-        estimates.append(estimate)
-
-    # Update scatter plots
-    scatter_inside.set_offsets(np.c_[points_x_inside, points_y_inside])
-    scatter_outside.set_offsets(np.c_[points_x_outside, points_y_outside])
 
-    # Update line plot
-    line.set_data(range(len(estimates)), estimates)
-    if len(estimates) == 0:
-        line_pi.set_data([0, 1], [np.pi, np.pi])
-    else:
-        line_pi.set_data([0, len(estimates)], [np.pi, np.pi])
-
-    ax[1].relim()
-    ax[1].autoscale_view()
-
-
-    ax[1].set_title(f'Estimate of Pi: {estimate}')
-    ax[1].set_xlabel('Number of Points')
-    ax[1].set_ylabel('Estimate Value')
-
-    # Update the figure
-    fig.canvas.draw()
-
-
-def example(points=100, square_side_length=1, circle_diameter=1):
-    global points_inside_circle, total_points, estimates, estimate
-    global points_x_inside, points_y_inside, points_x_outside, points_y_outside, scatter_outside, scatter_inside
-    global line, line_pi
-    global fig, ax
-    circle_radius = 0.5*circle_diameter
-
-    # Initialize some variables
-    points_inside_circle = 0
-    total_points = 0
-    estimates = []
-    estimate = 0
-    points_x_inside = []
-    points_y_inside = []
-    points_x_outside = []
-    points_y_outside = []
-
-    # Initialize the plots
+class PiEstimator:
+    """
+    Estimate pi from the fraction of random points in a square that fall in a circle
+
+    Points are drawn in blocks of at most block_size with a numpy Generator and
+    only running sums are kept, so many millions of points need little memory.
+    The estimate is recorded at up to max_history points per call to add, and
+    the first max_points points are kept for plotting.
+
+    mode selects how the points are drawn:
+        "random"      independent uniform points
+        "stratified"  one uniform point in each cell of a grid over the square
+        "sobol"       scrambled Sobol quasi-random sequence
+    """
+    modes = ("random", "stratified", "sobol")
+
+    def __init__(self, square_side_length=1, circle_radius=0.5, mode="random", seed=None,
+                 block_size=1_000_000, max_points=2000, max_history=100):
+        if mode not in self.modes:
+            raise ValueError(f"mode must be one of {self.modes}")
+
+        self.square_side_length = square_side_length
+        self.circle_radius = circle_radius
+        self.mode = mode
+        self.block_size = block_size
+        self.max_points = max_points
+        self.max_history = max_history
+
+        self.rng = np.random.default_rng(seed)
+        if mode == "sobol":
+            self.sobol = qmc.Sobol(d=2, scramble=True, rng=self.rng)
+
+        self.total_points = 0
+        self.points_inside_circle = 0
+        self.history_points = []
+        self.history_estimates = []
+        self.points = np.zeros((0, 2))
+        self.inside = np.zeros(0, dtype=bool)
+
+    @property
+    def estimate(self):
+        if self.total_points == 0:
+            return 0
+        # area of circle / area of square = pi*circle_radius**2 / square_side_length**2
+        return self.square_side_length**2/self.circle_radius**2 * self.points_inside_circle / self.total_points
+
+    def sample(self, n):
+        """n points in the unit square"""
+        if self.mode == "random":
+            return self.rng.random((n, 2))
+
+        if self.mode == "stratified":
+            # One point in each cell of a k x k grid, the rest uniform. The points are
+            # shuffled so the running estimate does not sweep the grid row by row
+            k = int(np.sqrt(n))
+            cells = np.stack(np.meshgrid(np.arange(k), np.arange(k)), axis=-1).reshape(-1, 2)
+            grid_points = (cells + self.rng.random((k * k, 2))) / max(k, 1)
+            return self.rng.permutation(np.concatenate((grid_points, self.rng.random((n - k * k, 2)))))
+
+        with warnings.catch_warnings():
+            # The sequence continues between blocks, so block sizes need not be powers of 2
+            warnings.simplefilter("ignore", UserWarning)
+            return self.sobol.random(n)
+
+    def add(self, n):
+        """Draw n more points and update the running sums"""
+        remaining = n
+        while remaining > 0:
+            block = min(remaining, self.block_size)
+            points = self.sample(block) * self.square_side_length
+
+            center = 0.5 * self.square_side_length
+            inside = (points[:, 0] - center)**2 + (points[:, 1] - center)**2 <= self.circle_radius**2
+
+            # Record the estimate at evenly spaced points within the block
+            checkpoints = np.unique(np.linspace(0, block - 1, min(block, self.max_history)).astype(int))
+            inside_so_far = self.points_inside_circle + np.cumsum(inside)[checkpoints]
+            points_so_far = self.total_points + checkpoints + 1
+            scale = self.square_side_length**2/self.circle_radius**2
+            self.history_points.extend(points_so_far)
+            self.history_estimates.extend(scale * inside_so_far / points_so_far)
+
+            if len(self.points) < self.max_points:
+                keep = self.max_points - len(self.points)
+                self.points = np.concatenate((self.points, points[:keep]))
+                self.inside = np.concatenate((self.inside, inside[:keep]))
+
+            self.total_points += block
+            self.points_inside_circle += np.count_nonzero(inside)
+            remaining -= block
+
+        return self.estimate
+
+
+def setup_figure(square_side_length, circle_radius):
     fig, ax = plt.subplots(1, 2, figsize=(8, 6))
 
     # Create initial scatter plots and line plot
@@ -84,106 +116,104 @@ def example(points=100, square_side_length=1, circle_diameter=1):
     ax[0].add_patch(plt.Circle((0.5*square_side_length, 0.5*square_side_length), circle_radius, fill=False))
     ax[0].set_aspect('equal', 'box')
 
-    # Initial Plot
-    plot_points(square_side_length, circle_radius, 100)
-
-
-    plt.tight_layout()
-
+    return fig, ax, (scatter_inside, scatter_outside, line, line_pi)
 
-def example_interactive(square_side_length=1, circle_diameter=1):
-    global points_inside_circle, total_points, estimates, estimate
-    global points_x_inside, points_y_inside, points_x_outside, points_y_outside, scatter_inside, scatter_outside
 
-    circle_radius = 0.5*circle_diameter
+def update_figure(estimator, fig, ax, artists):
+    scatter_inside, scatter_outside, line, line_pi = artists
 
-    # Initialize some variables
-    points_inside_circle = 0
-    total_points = 0
-    estimates = []
-    estimate = 0
-    points_x_inside = []
-    points_y_inside = []
-    points_x_outside = []
-    points_y_outside = []
-
-    # Initialize the plots
-    fig, ax = plt.subplots(1, 2, figsize=(8, 6))
+    # Only the points kept by the estimator are drawn
+    scatter_inside.set_offsets(estimator.points[estimator.inside])
+    scatter_outside.set_offsets(estimator.points[~estimator.inside])
 
-    # Create initial scatter plots and line plot
-    scatter_inside = ax[0].scatter([], [], marker="x", color='g')
-    scatter_outside = ax[0].scatter([], [], marker="x", color='r')
-    line, = ax[1].plot([], [])
-    line_pi, = ax[1].plot([], [], "k--")
-    ax[1].text(0, np.pi, "$\\pi$", fontsize=20, va="top")
+    # Update line plot
+    line.set_data(estimator.history_points, estimator.history_estimates)
+    line_pi.set_data([0, max(estimator.total_points, 1)], [np.pi, np.pi])
 
-    # Draw square and circle
-    ax[0].add_patch(plt.Rectangle((0,0), square_side_length, square_side_length, fill=False))
-    ax[0].add_patch(plt.Circle((0.5*square_side_length, 0.5*square_side_length), circle_radius, fill=False))
-    ax[0].set_aspect('equal', 'box')
+    ax[1].relim()
+    ax[1].autoscale_view()
 
-    # Function to update plots and estimate Pi
-    def plot_points(n=1):
-        global points_inside_circle, total_points, estimates, estimate
-        global points_x_inside, points_y_inside, points_x_outside, points_y_outside, scatter_inside, scatter_outside
+    ax[1].set_title(f'Estimate of Pi: {estimator.estimate}')
+    ax[1].set_xlabel('Number of Points')
+    ax[1].set_ylabel('Estimate Value')
 
-        for _ in range(n):
-            x, y = np.random.rand(2)*square_side_length  # Random points x, y between 0 and 1
-            distance = np.sqrt((x-0.5*square_side_length)**2 + (y-0.5*square_side_length)**2)
+    # Update the figure
+    fig.canvas.draw()
 
-            total_points += 1
 
-            if distance <= circle_radius:
-                points_inside_circle += 1
-                points_x_inside.append(x)
-                points_y_inside.append(y)
-            else:
-                points_x_outside.append(x)
-                points_y_outside.append(y)
+def example(points=100, square_side_length=1, circle_diameter=1):
+    estimator = PiEstimator(square_side_length, 0.5*circle_diameter)
+    fig, ax, artists = setup_figure(square_side_length, estimator.circle_radius)
 
-            # area of circle = pi*circle_radius**2
-            # area of box = side_length**2
-            # estimate =
+    estimator.add(points)
+    update_figure(estimator, fig, ax, artists)
 
-            estimate = square_side_length**2/circle_radius**2 * points_inside_circle / total_points
-            estimates.append(estimate)
+    plt.tight_layout()
 
-        # Update scatter plots
-        scatter_inside.set_offsets(np.c_[points_x_inside, points_y_inside])
-        scatter_outside.set_offsets(np.c_[points_x_outside, points_y_outside])
 
-        # Update line plot
-        line.set_data(range(len(estimates)), estimates)
-        if len(estimates) == 0:
-            line_pi.set_data([0, 1], [np.pi, np.pi])
-        else:
-            line_pi.set_data([0, len(estimates)], [np.pi, np.pi])
+def example_interactive(square_side_length=1, circle_diameter=1, mode="random", seed=None):
+    circle_radius = 0.5*circle_diameter
+    state = {"estimator": PiEstimator(square_side_length, circle_radius, mode=mode, seed=seed)}
 
-        ax[1].relim()
-        ax[1].autoscale_view()
-        ax[1].set_xlabel('Number of Points')
-        ax[1].set_ylabel('Estimate Value')
+    fig, ax, artists = setup_figure(square_side_length, circle_radius)
 
-        # Update the figure
-        fig.canvas.draw()
+    def plot_points(n):
+        state["estimator"].add(n)
+        update_figure(state["estimator"], fig, ax, artists)
 
-    # Create a button to add a random point
-    button = widgets.Button(description='Add Point')
+    # Buttons adding points, large numbers are drawn in blocks
+    buttons = []
+    for n, description in ((1, 'Add Point'), (10, 'Add 10 Points'),
+                           (10_000, 'Add 10^4 Points'), (1_000_000, 'Add 10^6 Points')):
+        button = widgets.Button(description=description)
+        button.on_click(lambda b, n=n: plot_points(n))
+        buttons.append(button)
 
-    def on_button_click(b):
-        plot_points(1)
-    button.on_click(on_button_click)
+    # Changing the sampling mode starts again
+    mode_selector = widgets.Dropdown(options=PiEstimator.modes, value=mode, description='Sampling')
 
-    ten_button = widgets.Button(description='Add 10 Points')
-    def on_ten_button_click(b):
-        plot_points(10)
-    ten_button.on_click(on_ten_button_click)
+    def on_mode_change(change):
+        state["estimator"] = PiEstimator(square_side_length, circle_radius, mode=change["new"], seed=seed)
+        plot_points(0)
+    mode_selector.observe(on_mode_change, names="value")
 
     # Initial Plot
     plot_points(0)
 
     # Display button
-    display(button)
-    display(ten_button)
+    display(mode_selector)
+    for button in buttons:
+        display(button)
+
+    plt.tight_layout()
+
+
+def convergence(points=10**7, square_side_length=1, circle_diameter=1, seed=None):
+    """
+    Compare the error of the sampling modes as the number of points grows
+
+    Plots |estimate - pi| against the number of points for each mode together
+    with the 1/sqrt(N) scaling of independent random points.
+    """
+    fig, ax = plt.subplots(figsize=(8, 6))
+
+    # Evaluate at logarithmically spaced numbers of points
+    steps = np.unique(np.logspace(1, np.log10(points), 40).astype(int))
+    for mode in PiEstimator.modes:
+        estimator = PiEstimator(square_side_length, 0.5*circle_diameter, mode=mode, seed=seed,
+                                max_points=0, max_history=1)
+        errors = []
+        for total in steps:
+            estimator.add(total - estimator.total_points)
+            errors.append(abs(estimator.estimate - np.pi))
+        ax.loglog(steps, errors, label=mode)
+
+    # Standard error of independent points, the estimate is scale times a fraction p
+    scale = square_side_length**2 / (0.5*circle_diameter)**2
+    p = np.pi / scale
+    ax.loglog(steps, scale * np.sqrt(p * (1 - p) / steps), "k--", label="$1/\\sqrt{N}$")
+    ax.set_xlabel('Number of Points')
+    ax.set_ylabel('|Estimate - $\\pi$|')
+    ax.legend()
 
     plt.tight_layout()
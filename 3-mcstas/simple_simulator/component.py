@@ -1,17 +1,94 @@
 import numpy as np
 import math
-import random
 from scipy.spatial.transform import Rotation as R
 
+from . import kernels
+from .ray import RayBatch, WAVELENGTH_SPEED, crossing_times
+
+
+def _move_to_plane(rays, axis, half_width, half_height):
+    # Move the rays hitting the rectangle in the x=0 (axis 0) or z=0 (axis 2) plane onto it,
+    # returns the mask of those rays
+    if rays.gravity is None:
+        intersection, hit = kernels.intersect_plane(rays.position, rays.direction, axis,
+                                                    half_width, half_height)
+        rays.time[hit] -= rays.position[hit, axis] / (rays.direction[hit, axis] * rays.speed[hit])
+        rays.position[hit] = intersection[hit]
+        return hit
+
+    # A parabola can cross the plane twice, the first crossing inside the rectangle counts
+    across = 2 if axis == 0 else 0
+    t = np.full(len(rays), np.inf)
+    for crossing in crossing_times(-rays.position[:, axis], rays.velocity[:, axis], rays.gravity[axis]):
+        intersection = rays.position_at(crossing)
+        with np.errstate(invalid='ignore'):
+            inside = ((crossing >= 0) & (np.abs(intersection[:, across]) <= half_width)
+                      & (np.abs(intersection[:, 1]) <= half_height))
+        t = np.where(inside, np.minimum(t, crossing), t)
+
+    hit = np.isfinite(t)
+    rays.move(t[hit], hit)
+    return hit
+
+
+def _interact_as_batch(component, ray):
+    # The per-ray path reuses the batch code with a bundle of one ray
+    rays = RayBatch([ray.history[-1]], [ray.direction], [ray.weight], max_points=1,
+                    speed=[ray.speed], time=[ray.time])
+    component.interact_batch(rays)
+    for point in rays.history[0, :rays.num_points[0]]:
+        ray.add_point(point)
+    ray.set_direction(rays.direction[0])
+    ray.weight = rays.weight[0]
+
+    return ray
+
 
 class Component:
     def __init__(self, position=np.array([0, 0, 0]), rotation=np.array([0, 0, 0])):
         self.position = np.array(position)
         self.rotation = np.array(rotation)
+        self.version = 0  # Counts changes of the global coordinates, see Simulator.compile
         self.global_position = None
         self.global_rotation = None
         self.is_monitor = False
 
+    @property
+    def global_position(self):
+        return self._global_position
+
+    @global_position.setter
+    def global_position(self, value):
+        self._global_position = value
+        self._to_global_matrix = None
+        self._to_local_matrix = None
+        self.version += 1
+
+    @property
+    def global_rotation(self):
+        return self._global_rotation
+
+    @global_rotation.setter
+    def global_rotation(self, value):
+        self._global_rotation = value
+        self._to_global_matrix = None
+        self._to_local_matrix = None
+        self.version += 1
+
+    @property
+    def to_global_matrix(self):
+        # Rotation matrices are cached until the global coordinates change
+        if self._to_global_matrix is None:
+            self._to_global_matrix = R.from_euler('xyz', self.global_rotation, degrees=True).as_matrix()
+        return self._to_global_matrix
+
+    @property
+    def to_local_matrix(self):
+        if self._to_local_matrix is None:
+            # The inverse rotation, negating the Euler angles is only the inverse about a single axis
+            self._to_local_matrix = self.to_global_matrix.T
+        return self._to_local_matrix
+
     def set_global_coordinates(self, parent_position, parent_rotation):
         rotation_matrix = R.from_euler('xyz', parent_rotation, degrees=True)
         self.global_position = rotation_matrix.apply(self.position) + parent_position
@@ -20,22 +97,42 @@ class Component:
     def interact(self, ray):
         return ray
 
+    def interact_batch(self, rays):
+        return rays
+
     def visualize(self, ax):
         pass
 
 class Source(Component):
     def __init__(self, position=[0, 0, 0], rotation=[0, 0, 0],
-                 normal=[0,0,1], width=1, height=1, angle_spread=1):
+                 normal=[0,0,1], width=1, height=1, angle_spread=1,
+                 wavelength=(1, 10), pulse_length=0, rng=None):
         super().__init__(position, rotation)
         self.normal = np.array(normal) / np.linalg.norm(normal)  # Ensure it's a unit vector
         self.width = width
         self.height = height
         self.angle_spread = math.radians(angle_spread)  # Convert to radians
+        self.wavelength = wavelength  # Range [Å] sampled uniformly, or a single wavelength
+        self.pulse_length = pulse_length  # Emission times are uniform in [0, pulse_length] s
+        self.rng = np.random.default_rng(rng)  # Accepts a seed, SeedSequence or Generator
+
+    @property
+    def normal(self):
+        return self._normal
+
+    @normal.setter
+    def normal(self, value):
+        self._normal = np.array(value) / np.linalg.norm(value)  # Ensure it's a unit vector
+
+        # Rotation aligning deviation vectors with the source's normal, only changes with the normal
+        rotation_axis = np.cross([0, 0, 1], self._normal)
+        rotation_angle = math.acos(np.dot([0, 0, 1], self._normal))
+        self.normal_rotation_matrix = R.from_rotvec(rotation_angle * rotation_axis).as_matrix()
 
     def interact(self, ray):
         # Calculate the random starting point on the rectangle
-        offset_x = random.uniform(-self.width / 2, self.width / 2)
-        offset_y = random.uniform(-self.height / 2, self.height / 2)
+        offset_x = self.rng.uniform(-self.width / 2, self.width / 2)
+        offset_y = self.rng.uniform(-self.height / 2, self.height / 2)
 
         # Starting point in the local coordinate system
         local_start_point = np.array([offset_x, offset_y, 0])
@@ -44,8 +141,8 @@ class Source(Component):
         ray.add_point(local_start_point)
 
         # Add random angular deviation to the normal vector for the ray direction
-        theta = random.uniform(-self.angle_spread, self.angle_spread)
-        phi = random.uniform(0, 2 * math.pi)
+        theta = self.rng.uniform(-self.angle_spread, self.angle_spread)
+        phi = self.rng.uniform(0, 2 * math.pi)
 
         dx = math.sin(theta) * math.cos(phi)
         dy = math.sin(theta) * math.sin(phi)
@@ -54,19 +151,44 @@ class Source(Component):
         deviation_vector = np.array([dx, dy, dz])
 
         # Rotate deviation vector to align with the source's normal
-        rotation_axis = np.cross([0, 0, 1], self.normal)
-        rotation_angle = math.acos(np.dot([0, 0, 1], self.normal))
-
-        rotation_matrix = R.from_rotvec(rotation_angle * rotation_axis)
-        rotated_deviation = rotation_matrix.apply(deviation_vector)
+        rotated_deviation = self.normal_rotation_matrix @ deviation_vector
 
         final_direction = self.normal + rotated_deviation
         final_direction = final_direction / np.linalg.norm(final_direction)  # Re-normalize to unit vector
 
         ray.set_direction(final_direction)
 
+        low, high = np.broadcast_to(self.wavelength, (2,))
+        ray.speed = WAVELENGTH_SPEED / self.rng.uniform(low, high)
+        ray.start_time = self.rng.uniform(0, self.pulse_length)
+
         return ray
 
+    def interact_batch(self, rays):
+        n = len(rays)
+
+        # Random starting points on the rectangle, all in one go
+        rays.position[:, 0] = self.rng.uniform(-self.width / 2, self.width / 2, n)
+        rays.position[:, 1] = self.rng.uniform(-self.height / 2, self.height / 2, n)
+        rays.position[:, 2] = 0
+        rays.add_points()
+
+        theta = self.rng.uniform(-self.angle_spread, self.angle_spread, n)
+        phi = self.rng.uniform(0, 2 * math.pi, n)
+
+        deviation_vectors = np.column_stack((np.sin(theta) * np.cos(phi),
+                                             np.sin(theta) * np.sin(phi),
+                                             np.cos(theta)))
+
+        rays.direction = self.normal + deviation_vectors @ self.normal_rotation_matrix.T
+        rays.normalize()
+
+        low, high = np.broadcast_to(self.wavelength, (2,))
+        rays.speed = WAVELENGTH_SPEED / self.rng.uniform(low, high, n)
+        rays.time = self.rng.uniform(0, self.pulse_length, n)
+
+        return rays
+
     def visualize(self, ax):
         # Create the 4 corners of the rectangle in the local coordinate system
         half_width = self.width / 2
@@ -114,6 +236,11 @@ class Propagator(Component):
 
         return ray
 
+    def interact_batch(self, rays):
+        rays.propagate(self.distance)
+        rays.add_points()
+        return rays
+
     def visualize(self, ax):
         # Visualization for the Propagator could be a line segment indicating
         # the direction and distance of propagation. We'll start the line at the
@@ -138,6 +265,9 @@ class Arm(Component):
     def interact(self, ray):
         return ray
 
+    def interact_batch(self, rays):
+        return rays
+
     def visualize(self, ax):
         # Visualization for the Propagator could be a line segment indicating
         # the direction and distance of propagation. We'll start the line at the
@@ -203,6 +333,19 @@ class Mirror(Component):
                 print("  ", history)
 
         return ray
+
+    def interact_batch(self, rays):
+        # The mirror is the x=0 plane
+        hit = _move_to_plane(rays, 0, self.width / 2, self.height / 2)
+
+        # Reflection in the x=0 plane flips the x component of the direction
+        rays.direction[hit, 0] *= -1
+        rays.add_points(hit)
+
+        if self.verbose:
+            print("hit", np.count_nonzero(hit), "of", len(rays))
+
+        return rays
     """
     def visualize(self, ax):
         # Create the 4 corners of the square mirror in the local coordinate system
@@ -257,8 +400,23 @@ class Monitor(Component):
         self.is_monitor = True
         self.nx = nx
         self.ny = ny
-        self.intensity = np.zeros((nx, ny))
-        self.counts = np.zeros((nx, ny))
+        self.reset()
+
+    def reset(self):
+        self.intensity = np.zeros((self.nx, self.ny))
+        self.intensity_squared = np.zeros((self.nx, self.ny))  # Sum of squared weights for error bars
+        self.counts = np.zeros((self.nx, self.ny))
+
+    def get_tallies(self):
+        return {"intensity": self.intensity,
+                "intensity_squared": self.intensity_squared,
+                "counts": self.counts}
+
+    def add_tallies(self, tallies):
+        # Tallies are plain sums, so runs on separate rays can be merged by adding them
+        self.intensity += tallies["intensity"]
+        self.intensity_squared += tallies["intensity_squared"]
+        self.counts += tallies["counts"]
 
     def interact(self, ray):
         # Assume the ray's last point is its current position
@@ -296,6 +454,7 @@ class Monitor(Component):
         index_y = int(np.floor(self.ny*detector_y/self.height))
 
         self.intensity[index_x, index_y] += ray.weight
+        self.intensity_squared[index_x, index_y] += ray.weight**2
         self.counts[index_x, index_y] += 1
 
         # Add the intersection point to the ray's history
@@ -308,6 +467,28 @@ class Monitor(Component):
 
         return ray
 
+    def add_hits(self, rays, selection):
+        kernels.histogram_2d(rays.position[selection, 0] + self.width / 2,
+                             rays.position[selection, 1] + self.height / 2,
+                             rays.weight[selection], self.width, self.height,
+                             self.intensity, self.intensity_squared, self.counts)
+
+    def interact_batch(self, rays):
+        # The monitor is the z=0 plane
+        hit = _move_to_plane(rays, 2, self.width / 2, self.height / 2)
+        rays.add_points(hit)
+
+        self.add_hits(rays, hit)
+
+        if self.verbose:
+            print("hit", np.count_nonzero(hit), "of", len(rays))
+
+        return rays
+
+    def get_errors(self):
+        # Statistical uncertainty of the intensity in each bin
+        return np.sqrt(self.intensity_squared)
+
     def get_visualization_points(self):
 
         corner1 = np.array([-self.width / 2, -self.height / 2, 0])
@@ -339,6 +520,88 @@ class Monitor(Component):
         pass
 
 
+class Monitor1D(Monitor):
+    """
+    Monitor histogramming a single quantity of the rays that hit it
+
+    Subclasses implement get_values, returning the quantity for the selected
+    rays. Values outside limits are not recorded.
+    """
+    def __init__(self, position=[0, 0, 0], rotation=[0, 0, 0],
+                 width=1, height=1, bins=50, limits=(0, 1), verbose=False):
+        self.bins = bins
+        self.limits = limits
+        super().__init__(position, rotation, width=width, height=height,
+                         nx=bins, ny=1, verbose=verbose)
+
+    def reset(self):
+        self.intensity = np.zeros(self.bins)
+        self.intensity_squared = np.zeros(self.bins)
+        self.counts = np.zeros(self.bins)
+
+    def get_values(self, rays, selection):
+        raise NotImplementedError
+
+    def get_indices(self, rays, selection):
+        """Histogram index for the selected rays, -1 outside the limits"""
+        low, high = self.limits
+        values = self.get_values(rays, selection)
+        index = np.floor(self.bins * (values - low) / (high - low)).astype(int)
+        return np.where((index >= 0) & (index < self.bins), index, -1)
+
+    def add_hits(self, rays, selection):
+        index = self.get_indices(rays, selection)
+        inside = index >= 0
+        kernels.histogram_1d(index[inside], rays.weight[selection][inside],
+                             self.intensity, self.intensity_squared, self.counts)
+
+    def interact(self, ray):
+        return _interact_as_batch(self, ray)
+
+    def get_axis(self):
+        # Bin centers
+        edges = np.linspace(self.limits[0], self.limits[1], self.bins + 1)
+        return 0.5 * (edges[:-1] + edges[1:])
+
+
+class DivergenceMonitor(Monitor1D):
+    def __init__(self, position=[0, 0, 0], rotation=[0, 0, 0],
+                 width=1, height=1, bins=50, limits=(-5, 5), axis="horizontal", verbose=False):
+        if axis not in ("horizontal", "vertical"):
+            raise ValueError("axis must be 'horizontal' or 'vertical'")
+        self.axis = axis
+        super().__init__(position, rotation, width=width, height=height,
+                         bins=bins, limits=limits, verbose=verbose)
+
+    def get_values(self, rays, selection):
+        # Angle to the monitor normal in degrees
+        direction = rays.direction[selection]
+        transverse = direction[:, 0] if self.axis == "horizontal" else direction[:, 1]
+        return np.degrees(np.arctan2(transverse, direction[:, 2]))
+
+
+class TOFMonitor(Monitor1D):
+    """Time-of-flight monitor, limits in µs"""
+    def __init__(self, position=[0, 0, 0], rotation=[0, 0, 0],
+                 width=1, height=1, bins=50, limits=(0, 1e5), verbose=False):
+        super().__init__(position, rotation, width=width, height=height,
+                         bins=bins, limits=limits, verbose=verbose)
+
+    def get_values(self, rays, selection):
+        return rays.time[selection] * 1e6
+
+
+class WavelengthMonitor(Monitor1D):
+    """Wavelength monitor, limits in Å"""
+    def __init__(self, position=[0, 0, 0], rotation=[0, 0, 0],
+                 width=1, height=1, bins=50, limits=(0, 10), verbose=False):
+        super().__init__(position, rotation, width=width, height=height,
+                         bins=bins, limits=limits, verbose=verbose)
+
+    def get_values(self, rays, selection):
+        return WAVELENGTH_SPEED / rays.speed[selection]
+
+
 class RectangularTube(Component):
     def __init__(self, position=[0, 0, 0], rotation=[0, 0, 0],
                  width=0.1, height=0.1, length=1, verbose=False):
@@ -458,6 +721,145 @@ class RectangularTube(Component):
 
         return ray
 
+    def unfold(self, position, direction):
+        """
+        Closed form transport of rays through the tube by unfolding the walls
+
+        Reflections in a rectangular tube mirror the transverse coordinates, so
+        each coordinate moves on a straight line through a row of mirror images
+        of the tube and can be folded back at the exit. The rays have to enter
+        through the opening and move forward (direction z > 0).
+
+        Returns the position of the last reflection (unchanged if there is none),
+        the direction after it and the number of reflections for each ray.
+        """
+        return kernels.unfold_tube(np.asarray(position, dtype=float),
+                                   np.asarray(direction, dtype=float),
+                                   self.width, self.height, self.length)
+
+    def interact_batch(self, rays):
+        if rays.history is not None or rays.gravity is not None:
+            # Every reflection point is needed for the history, and gravity bends
+            # the trajectories so they can not be unfolded
+            return self.interact_batch_iterative(rays)
+
+        position = rays.position
+        direction = rays.direction
+
+        # Rays entering through the opening while moving forward can be unfolded
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_entry = np.maximum(-position[:, 2], 0) / direction[:, 2]
+        entry = position + t_entry[:, np.newaxis] * direction
+        forward = direction[:, 2] > 0
+        opening = ((np.abs(entry[:, 0]) <= self.width/2) & (np.abs(entry[:, 1]) <= self.height/2)
+                   & (position[:, 2] < self.length))
+
+        analytic = forward & opening
+        start_z = position[analytic, 2]
+        rays.position[analytic], rays.direction[analytic], _ = self.unfold(
+            position[analytic], direction[analytic])
+
+        # Reflections leave the z component of the direction unchanged
+        rays.time[analytic] += ((rays.position[analytic, 2] - start_z)
+                                / (rays.direction[analytic, 2] * rays.speed[analytic]))
+
+        # Rays beyond the exit moving forward never hit a wall, the rest take the iterative path
+        passing = forward & (position[:, 2] >= self.length)
+        return self.interact_batch_iterative(rays, ~(analytic | passing))
+
+    def interact_batch_iterative(self, rays, selection=None):
+        """
+        Reference batch implementation following interact reflection by reflection
+
+        With gravity the reflections are found on the parabolic trajectories.
+        """
+        max_reflections = 500  # Set a limit to avoid infinite loop
+
+        # Walls in the same order as in interact: bottom, top, left, right.
+        # Each wall is given by the axis it is perpendicular to and its coordinate,
+        # together with the axis and half size used for the boundary check.
+        wall_axis = np.array([1, 1, 0, 0])
+        wall_value = np.array([-self.height/2, self.height/2, -self.width/2, self.width/2])
+        across_axis = np.array([0, 0, 1, 1])
+        across_half = np.array([self.width/2, self.width/2, self.height/2, self.height/2])
+
+        # Only the rays still bouncing are kept in the working set
+        active = np.arange(len(rays))
+        if selection is not None:
+            active = active[selection]
+        last_side = np.full(len(rays), -1)
+
+        for _ in range(max_reflections):
+            if len(active) == 0:
+                break
+
+            position = rays.position[active]
+            direction = rays.direction[active]
+            previous = last_side[active]
+            on_wall = previous >= 0
+
+            if rays.gravity is None:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    t = (wall_value - position[:, wall_axis]) / direction[:, wall_axis]
+                intersection_along = position[:, 2, np.newaxis] + t * direction[:, 2, np.newaxis]
+                intersection_across = position[:, across_axis] + t * direction[:, across_axis]
+
+                valid = ((t >= 0) & np.isfinite(t)
+                         & (np.abs(intersection_across) <= across_half)
+                         & (intersection_along >= 0) & (intersection_along <= self.length))
+
+                # Skip the last side as the ray is on that side
+                valid[on_wall, previous[on_wall]] = False
+            else:
+                # Here t is a time. A parabola can cross a wall plane twice, the
+                # first crossing inside the wall counts.
+                velocity = direction * rays.speed[active, np.newaxis]
+                first, second = crossing_times(wall_value - position[:, wall_axis],
+                                               velocity[:, wall_axis], rays.gravity[wall_axis])
+
+                # A ray on a wall can only come back to it at the crossing away from the start
+                start = np.zeros(first.shape, dtype=bool)
+                start[on_wall, previous[on_wall]] = True
+                first_is_start = np.abs(first) < np.abs(second)
+                first = np.where(start & first_is_start, np.nan, first)
+                second = np.where(start & ~first_is_start, np.nan, second)
+
+                t = np.full(first.shape, np.inf)
+                for crossing in (first, second):
+                    with np.errstate(invalid='ignore'):
+                        intersection_along = (position[:, 2, np.newaxis]
+                                              + crossing * velocity[:, 2, np.newaxis]
+                                              + 0.5 * rays.gravity[2] * crossing**2)
+                        intersection_across = (position[:, across_axis]
+                                               + crossing * velocity[:, across_axis]
+                                               + 0.5 * rays.gravity[across_axis] * crossing**2)
+                        inside = ((crossing >= 0)
+                                  & (np.abs(intersection_across) <= across_half)
+                                  & (intersection_along >= 0) & (intersection_along <= self.length))
+                    t = np.where(inside, np.minimum(t, crossing), t)
+                valid = np.isfinite(t)
+
+            t = np.where(valid, t, np.inf)
+            side = np.argmin(t, axis=1)
+            t_closest = t[np.arange(len(active)), side]
+
+            # Rays that do not hit any wall have left the tube
+            reflected = np.isfinite(t_closest)
+            active = active[reflected]
+            side = side[reflected]
+            t_closest = t_closest[reflected]
+
+            if rays.gravity is None:
+                rays.position[active] += t_closest[:, np.newaxis] * rays.direction[active]
+                rays.time[active] += t_closest / rays.speed[active]
+            else:
+                rays.move(t_closest, active)
+            rays.direction[active, wall_axis[side]] *= -1
+            rays.add_points(active)
+            last_side[active] = side
+
+        return rays
+
     def get_visualization_points(self):
         # Define corner points for visualization
 
@@ -474,3 +876,134 @@ class RectangularTube(Component):
                 corner5, corner6, corner2, corner6,
                 corner7, corner3, corner7, corner8,
                 corner4, corner8, corner5)]
+
+
+class CurvedGuide(Component):
+    """
+    Curved guide made of straight rectangular segments
+
+    Like the chain of Guide_gravity segments in make_powder_instrument.add_guide,
+    each segment is placed gap after the end of the previous one and turned by
+    curvature / num_segments degrees around the y axis, the first one included.
+    length is the summed length of the segments.
+
+    Rays enter through the opening of the first segment and are handed from
+    segment to segment, so each ray is only traced in the segment it is in.
+    Rays that miss the opening of a segment leave the guide at the exit of the
+    previous one and are not traced further by the guide.
+    """
+    def __init__(self, position=[0, 0, 0], rotation=[0, 0, 0],
+                 width=0.08, height=0.12, length=133.45, num_segments=9, curvature=1.0,
+                 gap=3e-3, verbose=False):
+        super().__init__(position, rotation)
+        self.width = width
+        self.height = height
+        self.length = length
+        self.num_segments = num_segments
+        self.curvature = curvature
+        self.gap = gap
+        self.verbose = verbose
+
+        segment_length = length / num_segments
+        self.segments = [RectangularTube(width=width, height=height, length=segment_length)
+                         for _ in range(num_segments)]
+
+        # Rotation to the guide coordinates and entrance position of each segment
+        self.segment_matrices = []
+        self.segment_positions = []
+        position = np.zeros(3)
+        for index in range(num_segments):
+            matrix = R.from_euler('xyz', [0, (index + 1) * curvature / num_segments, 0],
+                                  degrees=True).as_matrix()
+            self.segment_matrices.append(matrix)
+            self.segment_positions.append(position)
+            position = position + matrix @ np.array([0, 0, segment_length + gap])
+
+    def interact(self, ray):
+        return _interact_as_batch(self, ray)
+
+    def interact_batch(self, rays):
+        # The rays still in the guide, in the guide coordinates
+        active = np.arange(len(rays))
+        position = rays.position
+        direction = rays.direction
+        speed = rays.speed
+        time = rays.time
+
+        for matrix, segment_position, segment in zip(self.segment_matrices, self.segment_positions,
+                                                     self.segments):
+            local_position = (position - segment_position) @ matrix
+            local_direction = direction @ matrix
+
+            # Only rays entering the opening of this segment continue
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_entry = np.maximum(-local_position[:, 2], 0) / local_direction[:, 2]
+            entry = local_position + t_entry[:, np.newaxis] * local_direction
+            entering = ((local_direction[:, 2] > 0) & (local_position[:, 2] < segment.length)
+                        & (np.abs(entry[:, 0]) <= self.width / 2)
+                        & (np.abs(entry[:, 1]) <= self.height / 2))
+            if not entering.all():
+                # The others leave the guide where they are
+                leaving = active[~entering]
+                rays.position[leaving] = position[~entering]
+                rays.direction[leaving] = direction[~entering]
+                rays.speed[leaving] = speed[~entering]
+                rays.time[leaving] = time[~entering]
+                active = active[entering]
+                local_position = local_position[entering]
+                local_direction = local_direction[entering]
+                speed = speed[entering]
+                time = time[entering]
+
+            if rays.history is None and rays.gravity is None:
+                start_z = local_position[:, 2]
+                local_position, local_direction, _ = segment.unfold(local_position, local_direction)
+
+                # Move the rays to the exit of the segment, ready for the next one.
+                # Reflections leave the z component of the direction unchanged.
+                time = time + (segment.length - start_z) / (local_direction[:, 2] * speed)
+                t_exit = (segment.length - local_position[:, 2]) / local_direction[:, 2]
+                local_position += t_exit[:, np.newaxis] * local_direction
+            else:
+                # Trace reflection by reflection, on parabolas with gravity
+                gravity = None if rays.gravity is None else rays.gravity @ matrix
+                max_points = None if rays.history is None else 1
+                segment_rays = RayBatch(local_position, local_direction, max_points=max_points,
+                                        speed=speed, time=time, gravity=gravity)
+                segment.interact_batch_iterative(segment_rays)
+
+                if rays.history is not None:
+                    # Record the reflection points in the guide coordinates
+                    points = segment_rays.history @ matrix.T + segment_position
+                    for index in range(points.shape[1]):
+                        recorded = segment_rays.num_points > index
+                        rays.position[active[recorded]] = points[recorded, index]
+                        rays.add_points(active[recorded])
+
+                # Move the rays to the exit of the segment, ready for the next one
+                t_exit = segment_rays.time_to_plane(2, segment.length)
+                segment_rays.move(np.where(np.isfinite(t_exit), t_exit, 0))
+
+                local_position, local_direction = segment_rays.position, segment_rays.direction
+                speed, time = segment_rays.speed, segment_rays.time
+
+            position = local_position @ matrix.T + segment_position
+            direction = local_direction @ matrix.T
+
+        rays.position[active] = position
+        rays.direction[active] = direction
+        rays.speed[active] = speed
+        rays.time[active] = time
+
+        if self.verbose:
+            print("transported", len(active), "of", len(rays))
+
+        return rays
+
+    def get_visualization_points(self):
+        points = []
+        for matrix, position, segment in zip(self.segment_matrices, self.segment_positions,
+                                             self.segments):
+            for outline in segment.get_visualization_points():
+                points.append(tuple(np.array(outline) @ matrix.T + position))
+        return points
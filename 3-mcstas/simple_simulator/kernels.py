@@ -0,0 +1,216 @@
+"""
+Kernels for the hot loops of the batch ray tracer
+
+Every kernel has a NumPy implementation working on whole arrays and a loop
+implementation handling one ray at a time. The loops are compiled with Numba
+when it is installed, which avoids the temporary arrays of the NumPy versions.
+Without Numba the NumPy versions are used. Both give the same results, the
+backend can be chosen with use_backend.
+
+intersect_plane(position, direction, axis, half_width, half_height)
+    Intersection of the rays with a rectangle in the x=0 (axis=0, mirror) or
+    z=0 (axis=2, monitor) plane. Returns the intersection points and a mask of
+    the rays that hit, the points are only meaningful for those rays.
+
+histogram_1d(index, weight, intensity, intensity_squared, counts)
+    Adds rays to the histogram bins at index in place. The index counts the
+    bins of the flattened histograms.
+
+histogram_2d(x, y, weight, width, height, intensity, intensity_squared, counts)
+    Adds rays at x in [0, width], y in [0, height] to the histograms in place.
+
+unfold_tube(position, direction, width, height, length)
+    Closed form transport through a rectangular tube, see RectangularTube.unfold.
+"""
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _intersect_plane_numpy(position, direction, axis, half_width, half_height):
+    # The rectangle spans z and y for the x=0 plane (mirror), x and y for z=0 (monitor)
+    across = 2 if axis == 0 else 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -position[:, axis] / direction[:, axis]
+    intersection = position + t[:, np.newaxis] * direction
+
+    hit = ((t >= 0) & np.isfinite(t)
+           & (np.abs(intersection[:, across]) <= half_width)
+           & (np.abs(intersection[:, 1]) <= half_height))
+
+    return intersection, hit
+
+
+def _intersect_plane_loop(position, direction, axis, half_width, half_height):
+    # Inlined rather than a helper, compiled kernels can only call compiled functions
+    across = 2 if axis == 0 else 0
+    n = position.shape[0]
+    intersection = np.empty((n, 3))
+    hit = np.zeros(n, dtype=np.bool_)
+
+    for i in range(n):
+        if direction[i, axis] == 0:
+            continue
+        t = -position[i, axis] / direction[i, axis]
+        if not (t >= 0 and math.isfinite(t)):
+            continue
+
+        for k in range(3):
+            intersection[i, k] = position[i, k] + t * direction[i, k]
+        hit[i] = (abs(intersection[i, across]) <= half_width
+                  and abs(intersection[i, 1]) <= half_height)
+
+    return intersection, hit
+
+
+def _histogram_1d_numpy(index, weight, intensity, intensity_squared, counts):
+    shape = intensity.shape
+    size = intensity.size
+
+    # One bincount per tally on the flattened histogram instead of a loop over rays
+    intensity += np.bincount(index, weights=weight, minlength=size).reshape(shape)
+    intensity_squared += np.bincount(index, weights=weight**2, minlength=size).reshape(shape)
+    counts += np.bincount(index, minlength=size).reshape(shape)
+
+
+def _histogram_1d_loop(index, weight, intensity, intensity_squared, counts):
+    for i in range(index.shape[0]):
+        intensity[index[i]] += weight[i]
+        intensity_squared[index[i]] += weight[i]**2
+        counts[index[i]] += 1
+
+
+def _histogram_2d_numpy(x, y, weight, width, height, intensity, intensity_squared, counts):
+    nx, ny = intensity.shape
+
+    # Rays exactly on the far edge belong to the last pixel
+    index_x = np.minimum(np.floor(nx * x / width).astype(int), nx - 1)
+    index_y = np.minimum(np.floor(ny * y / height).astype(int), ny - 1)
+
+    _histogram_1d_numpy(index_x * ny + index_y, weight, intensity, intensity_squared, counts)
+
+
+def _histogram_2d_loop(x, y, weight, width, height, intensity, intensity_squared, counts):
+    nx, ny = intensity.shape
+
+    for i in range(x.shape[0]):
+        index_x = min(int(math.floor(nx * x[i] / width)), nx - 1)
+        index_y = min(int(math.floor(ny * y[i] / height)), ny - 1)
+
+        intensity[index_x, index_y] += weight[i]
+        intensity_squared[index_x, index_y] += weight[i]**2
+        counts[index_x, index_y] += 1
+
+
+def _unfold_tube_numpy(position, direction, width, height, length):
+    position = np.array(position, dtype=float)
+    direction = np.array(direction, dtype=float)
+
+    # Start from where the rays enter the tube
+    t_entry = np.maximum(-position[:, 2], 0) / direction[:, 2]
+    entry = position + t_entry[:, np.newaxis] * direction
+
+    size = np.array([width, height])
+    offset = entry[:, :2] + size / 2  # Transverse coordinates with the walls at 0 and size
+
+    # Coordinates at the exit in the unfolded picture, and the image index there
+    t_exit = (length - entry[:, 2]) / direction[:, 2]
+    image = np.floor((offset + t_exit[:, np.newaxis] * direction[:, :2]) / size).astype(int)
+    num_reflections = np.abs(image).sum(axis=1)
+
+    # The last wall crossed along each axis is the boundary of the final image
+    boundary = np.where(image > 0, image, image + 1) * size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_axis = (boundary - offset) / direction[:, :2]
+    t_axis = np.where(image != 0, t_axis, -np.inf)
+    t_last = t_axis.max(axis=1)
+
+    reflected = num_reflections > 0
+    unfolded = offset[reflected] + t_last[reflected, np.newaxis] * direction[reflected, :2]
+
+    # Fold the transverse coordinates back into the tube
+    folded = np.mod(unfolded, 2 * size)
+    folded = np.where(folded > size, 2 * size - folded, folded)
+
+    position[reflected, :2] = folded - size / 2
+    position[reflected, 2] = entry[reflected, 2] + t_last[reflected] * direction[reflected, 2]
+    direction[:, :2] *= np.where(image % 2 == 0, 1, -1)
+
+    return position, direction, num_reflections
+
+
+def _unfold_tube_loop(position, direction, width, height, length):
+    n = position.shape[0]
+    new_position = np.empty((n, 3))
+    new_direction = np.empty((n, 3))
+    num_reflections = np.zeros(n, dtype=np.int64)
+
+    for i in range(n):
+        t_entry = max(-position[i, 2], 0.0) / direction[i, 2]
+        entry_z = position[i, 2] + t_entry * direction[i, 2]
+        t_exit = (length - entry_z) / direction[i, 2]
+
+        t_last = -math.inf
+        for k in range(3):
+            new_position[i, k] = position[i, k]
+            new_direction[i, k] = direction[i, k]
+
+        for k in range(2):
+            size = width if k == 0 else height
+            offset = position[i, k] + t_entry * direction[i, k] + size / 2
+            image = int(math.floor((offset + t_exit * direction[i, k]) / size))
+            num_reflections[i] += abs(image)
+
+            if image != 0:
+                boundary = (image if image > 0 else image + 1) * size
+                t_last = max(t_last, (boundary - offset) / direction[i, k])
+            if image % 2 != 0:
+                new_direction[i, k] = -direction[i, k]
+
+        if num_reflections[i] == 0:
+            continue
+
+        # Fold the transverse coordinates at the last reflection back into the tube
+        for k in range(2):
+            size = width if k == 0 else height
+            offset = position[i, k] + t_entry * direction[i, k] + size / 2
+            folded = (offset + t_last * direction[i, k]) % (2 * size)
+            if folded > size:
+                folded = 2 * size - folded
+            new_position[i, k] = folded - size / 2
+        new_position[i, 2] = entry_z + t_last * direction[i, 2]
+
+    return new_position, new_direction, num_reflections
+
+
+_IMPLEMENTATIONS = {
+    "numpy": (_intersect_plane_numpy, _histogram_1d_numpy, _histogram_2d_numpy, _unfold_tube_numpy),
+}
+if numba is not None:
+    _IMPLEMENTATIONS["numba"] = tuple(
+        numba.njit(cache=True)(kernel)
+        for kernel in (_intersect_plane_loop, _histogram_1d_loop, _histogram_2d_loop, _unfold_tube_loop))
+
+backend = None
+intersect_plane = histogram_1d = histogram_2d = unfold_tube = None
+
+
+def use_backend(name):
+    """Select the kernels, "numba" or "numpy" """
+    global backend, intersect_plane, histogram_1d, histogram_2d, unfold_tube
+
+    if name not in ("numba", "numpy"):
+        raise ValueError("backend must be 'numba' or 'numpy'")
+    if name not in _IMPLEMENTATIONS:
+        raise ImportError("The numba backend needs numba to be installed")
+
+    backend = name
+    intersect_plane, histogram_1d, histogram_2d, unfold_tube = _IMPLEMENTATIONS[name]
+
+
+use_backend("numba" if numba is not None else "numpy")
@@ -1,17 +1,202 @@
 import numpy as np
 
+# Neutron wavelength [Å] times speed [m/s]
+WAVELENGTH_SPEED = 3956.034
+
+
+def crossing_times(distance, velocity, acceleration):
+    """
+    Both times t at which velocity * t + acceleration * t**2 / 2 = distance
+
+    Uses the numerically stable form of the quadratic formula, so acceleration
+    can be 0, the second time is then infinite. Times are nan if the distance
+    is never reached.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = np.sqrt(velocity**2 + 2 * acceleration * distance)
+        q = -(velocity + np.copysign(root, velocity)) / 2
+        return q / (acceleration / 2), -distance / q
+
+
+def earliest_time(distance, velocity, acceleration):
+    """First time t >= 0 at which the distance is reached, inf if never"""
+    first, second = crossing_times(distance, velocity, acceleration)
+    first = np.where(first >= 0, first, np.inf)
+    second = np.where(second >= 0, second, np.inf)
+    return np.minimum(first, second)
+
 
 class Ray:
+    # Slots keep the per-ray overhead small, the history lives in one array
+    __slots__ = ("color", "weight", "direction", "points", "num_points", "speed", "start_time")
+
     def __init__(self,
                  direction=np.array([0, 0, 1]),
-                 color='gray', weight=1):
+                 color='gray', weight=1, max_points=8, speed=2200.0, start_time=0.0):
         self.color = color
         self.weight = weight
-        self.history = []
+        self.speed = speed  # [m/s], thermal neutrons, 1.8 Å
+        self.start_time = start_time  # [s] at the first point of the history
+        self.points = np.zeros((max_points, 3))  # Preallocated history, grown when full
+        self.num_points = 0
         self.direction = direction / np.linalg.norm(direction)  # Ensure it's a unit vector
 
+    @property
+    def history(self):
+        # View of the recorded points, so it can be transformed in place
+        return self.points[:self.num_points]
+
+    @history.setter
+    def history(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if len(points) > len(self.points):
+            self.points = np.zeros((2 * len(points), 3))
+        self.points[:len(points)] = points
+        self.num_points = len(points)
+
+    @property
+    def time(self):
+        # The ray moves in straight lines between its points, so the time follows from the path length
+        path_length = np.linalg.norm(np.diff(self.history, axis=0), axis=1).sum()
+        return self.start_time + path_length / self.speed
+
     def add_point(self, point):
-        self.history.append(np.array(point))
+        if self.num_points == len(self.points):
+            self.points = np.concatenate((self.points, np.zeros((max(self.num_points, 8), 3))))
+        self.points[self.num_points] = point
+        self.num_points += 1
 
     def set_direction(self, direction):
         self.direction = direction / np.linalg.norm(direction)  # Ensure it's a unit vector
+
+
+class RayBatch:
+    """
+    Bundle of rays stored as arrays, used by the batch engine
+
+    Positions and directions have shape (N, 3), weights, speeds [m/s] and
+    times [s] shape (N,), so each component can move the whole bundle in a
+    few array operations. gravity is the acceleration [m/s^2] in the current
+    coordinates, or None for straight trajectories.
+    If max_points is given, the points each ray passes are recorded in a
+    preallocated (N, max_points, 3) history with a per-ray point count.
+    """
+    def __init__(self, position, direction, weight=None, max_points=None,
+                 speed=None, time=None, gravity=None):
+        self.position = np.array(position, dtype=float)
+        self.direction = np.array(direction, dtype=float)
+        self.normalize()
+
+        if weight is None:
+            weight = np.ones(len(self.position))
+        self.weight = np.array(weight, dtype=float)
+
+        if speed is None:
+            speed = np.full(len(self.position), 2200.0)  # Thermal neutrons, 1.8 Å
+        self.speed = np.array(speed, dtype=float)
+
+        if time is None:
+            time = np.zeros(len(self.position))
+        self.time = np.array(time, dtype=float)
+
+        self.gravity = None if gravity is None else np.array(gravity, dtype=float)
+
+        if max_points is None:
+            self.history = None
+            self.num_points = None
+        else:
+            self.history = np.zeros((len(self.position), max_points, 3))
+            self.num_points = np.zeros(len(self.position), dtype=int)
+
+    @classmethod
+    def empty(cls, num_rays, max_points=None, gravity=None):
+        position = np.zeros((num_rays, 3))
+        direction = np.zeros((num_rays, 3))
+        direction[:, 2] = 1
+        return cls(position, direction, max_points=max_points, gravity=gravity)
+
+    def __len__(self):
+        return len(self.position)
+
+    def normalize(self):
+        # Ensure all directions are unit vectors
+        self.direction /= np.linalg.norm(self.direction, axis=1)[:, np.newaxis]
+
+    @property
+    def velocity(self):
+        return self.direction * self.speed[:, np.newaxis]
+
+    @property
+    def wavelength(self):
+        return WAVELENGTH_SPEED / self.speed
+
+    def propagate(self, distance):
+        """Move all rays by distance [m], along a parabola of that flight time with gravity"""
+        if self.gravity is None:
+            self.position += self.direction * distance
+            self.time += distance / self.speed
+        else:
+            self.move(distance / self.speed)
+
+    def move(self, t, selection=None):
+        """Move the selected rays (boolean mask or indices) along their trajectories for t [s]"""
+        if selection is None:
+            selection = slice(None)
+        t = np.asarray(t, dtype=float)[..., np.newaxis]
+
+        velocity = self.direction[selection] * self.speed[selection, np.newaxis]
+        if self.gravity is None:
+            self.position[selection] += velocity * t
+        else:
+            self.position[selection] += velocity * t + 0.5 * self.gravity * t**2
+            velocity += self.gravity * t
+            speed = np.linalg.norm(velocity, axis=1)
+            self.speed[selection] = speed
+            self.direction[selection] = velocity / speed[:, np.newaxis]
+        self.time[selection] += t[..., 0]
+
+    def position_at(self, t):
+        """Positions of all rays after t [s], without moving them"""
+        t = t[:, np.newaxis]
+        with np.errstate(invalid='ignore'):
+            position = self.position + self.velocity * t
+            if self.gravity is not None:
+                position += 0.5 * self.gravity * t**2
+        return position
+
+    def time_to_plane(self, axis, value=0.0):
+        """Time [s] until each ray reaches the plane where coordinate axis is value, inf if never"""
+        acceleration = 0.0 if self.gravity is None else self.gravity[axis]
+        return earliest_time(value - self.position[:, axis], self.direction[:, axis] * self.speed,
+                             acceleration)
+
+    def add_points(self, selection=None):
+        """Record the current position of the selected rays (boolean mask or indices)"""
+        if self.history is None:
+            return
+
+        index = np.arange(len(self))
+        if selection is not None:
+            index = index[selection]
+        if len(index) == 0:
+            return
+
+        if self.num_points[index].max() == self.history.shape[1]:
+            self.history = np.concatenate((self.history, np.zeros_like(self.history)), axis=1)
+
+        self.history[index, self.num_points[index]] = self.position[index]
+        self.num_points[index] += 1
+
+    def to_rays(self, color='gray'):
+        """Ray objects sharing the recorded history, for Simulator.visualize"""
+        if self.history is None:
+            raise ValueError("No history recorded, give max_points when creating the rays")
+
+        rays = []
+        for index in range(len(self)):
+            ray = Ray(direction=self.direction[index], color=color,
+                      weight=self.weight[index], max_points=0)
+            ray.points = self.history[index]
+            ray.num_points = self.num_points[index]
+            rays.append(ray)
+        return rays
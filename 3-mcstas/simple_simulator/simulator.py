@@ -1,15 +1,40 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from mpl_toolkits.mplot3d import Axes3D
-from scipy.spatial.transform import Rotation as R
-from .component import Source, Arm, Propagator, Mirror, RectangularTube, Monitor
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+from .component import (Component, Source, Arm, Propagator, Mirror, RectangularTube, CurvedGuide, Monitor, DivergenceMonitor,
+                        TOFMonitor, WavelengthMonitor)
+
+from .ray import Ray, RayBatch
+
+def _run_shard(simulator, num_rays, batch_size, seed_sequence):
+    # Runs in a worker process on its own copy of the simulator
+    simulator.set_seed(seed_sequence)
+
+    monitors = [component for component in simulator.components if component.is_monitor]
+    for monitor in monitors:
+        monitor.reset()
+
+    simulator.run_streaming(num_rays, batch_size=batch_size)
+    return [monitor.get_tallies() for monitor in monitors]
+
+
+def _is_passive(component, method="interact_batch"):
+    # Components only defining a coordinate system leave the rays untouched
+    return isinstance(component, Arm) or getattr(type(component), method) is getattr(Component, method)
 
-from .ray import Ray
 
 class Simulator:
-    def __init__(self):
+    def __init__(self, gravity=False):
+        """With gravity the batch engine follows parabolic trajectories, falling along -y"""
         self.components = []
+        self.plan = None
+        self.plan_version = None
+        self.gravity = gravity
 
     def add_component(self, name, *args, relative=None, **kwargs):
         if name == "Source":
@@ -20,10 +45,18 @@ class Simulator:
             obj = Propagator(*args, **kwargs)
         elif name == "Guide":
             obj = RectangularTube(*args, **kwargs)
+        elif name == "CurvedGuide":
+            obj = CurvedGuide(*args, **kwargs)
         elif name == "Mirror":
             obj = Mirror(*args, **kwargs)
         elif name == "Monitor":
             obj = Monitor(*args, **kwargs)
+        elif name == "DivergenceMonitor":
+            obj = DivergenceMonitor(*args, **kwargs)
+        elif name == "TOFMonitor":
+            obj = TOFMonitor(*args, **kwargs)
+        elif name == "WavelengthMonitor":
+            obj = WavelengthMonitor(*args, **kwargs)
         else:
             raise ValueError("Unknown component name")
 
@@ -37,172 +70,310 @@ class Simulator:
             component.set_global_coordinates(np.array([0, 0, 0]), np.array([0, 0, 0]))
 
         self.components.append(component)
+        self.plan = None
+
+    def set_seed(self, seed=None):
+        """
+        Give every sampling component its own generator spawned from seed
+
+        seed can be an integer or a numpy SeedSequence, the streams of the
+        components are independent of each other.
+        """
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+
+        sampling_components = [component for component in self.components
+                               if getattr(component, "rng", None) is not None]
+        for component, child in zip(sampling_components, seed.spawn(len(sampling_components))):
+            component.rng = np.random.default_rng(child)
 
     def transform_to_local(self, ray, component):
-        rotation_matrix = R.from_euler('xyz', -component.global_rotation, degrees=True)
-        if len(ray.history) > 0:
-            local_history = rotation_matrix.apply(np.array(ray.history) - component.global_position)
-            ray.history = local_history.tolist()
-
-        rotation_matrix = R.from_euler('xyz', -component.global_rotation, degrees=True)
-        local_direction = rotation_matrix.apply(ray.direction)
-        ray.set_direction(local_direction)
+        rotation_matrix = component.to_local_matrix
+        history = ray.history
+        history[:] = (history - component.global_position) @ rotation_matrix.T
+
+        ray.set_direction(rotation_matrix @ ray.direction)
         return ray
 
     def transform_to_global(self, ray, component):
-        rotation_matrix = R.from_euler('xyz', component.global_rotation, degrees=True)
-        if len(ray.history) > 0:
-            global_history = rotation_matrix.apply(np.array(ray.history)) + component.global_position
-            ray.history = global_history.tolist()
-
-        rotation_matrix = R.from_euler('xyz', component.global_rotation, degrees=True)
-        global_direction = rotation_matrix.apply(ray.direction)
-        ray.set_direction(global_direction)
+        rotation_matrix = component.to_global_matrix
+        history = ray.history
+        history[:] = history @ rotation_matrix.T + component.global_position
+
+        ray.set_direction(rotation_matrix @ ray.direction)
         return ray
 
     def run(self, num_rays):
+        active_components = [component for component in self.components
+                             if not _is_passive(component, "interact")]
         rays = []
         for _ in range(num_rays):
             ray = Ray()
-            for component in self.components:
+            for component in active_components:
                 ray = self.transform_to_local(ray, component)
                 ray = component.interact(ray)
                 ray = self.transform_to_global(ray, component)
             rays.append(ray)
         return rays
 
-    def visualize(self, rays):
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection='3d')
+    def transform_batch_to_local(self, rays, component):
+        rotation_matrix = component.to_local_matrix
+        rays.position = (rays.position - component.global_position) @ rotation_matrix.T
+        rays.direction = rays.direction @ rotation_matrix.T
+        if rays.gravity is not None:
+            rays.gravity = rotation_matrix @ rays.gravity
+        if rays.history is not None:
+            rays.history = (rays.history - component.global_position) @ rotation_matrix.T
+        return rays
+
+    def transform_batch_to_global(self, rays, component):
+        rotation_matrix = component.to_global_matrix
+        rays.position = rays.position @ rotation_matrix.T + component.global_position
+        rays.direction = rays.direction @ rotation_matrix.T
+        if rays.gravity is not None:
+            rays.gravity = rotation_matrix @ rays.gravity
+        if rays.history is not None:
+            rays.history = rays.history @ rotation_matrix.T + component.global_position
+        return rays
+
+    def compile(self):
+        """
+        Turn the components into a flat execution plan for run_batch
+
+        The plan is a list of steps:
+          ("transform", matrix, offset)  position -> position @ matrix.T + offset
+          ("propagate", distance)        move the rays along their direction
+          ("interact", component)        component.interact_batch in its local frame
+        The transform out of one component and into the next are folded into
+        a single transform, components that do nothing to the rays (Arm) are
+        dropped and consecutive propagators are merged, as propagation along
+        the direction is the same in every coordinate system. With gravity the
+        flight time of a propagator depends on the speed at its start, so they
+        are not merged.
+
+        run_batch makes the plan again after components are added or moved or
+        gravity is switched, call compile again after changing a component in
+        place, e.g. the distance of a Propagator.
+        """
+        plan = []
+        # The frame the rays are in, as the matrix and position taking it to global
+        frame_matrix, frame_position = np.eye(3), np.zeros(3)
 
         for component in self.components:
-            component.visualize(ax)
-        for ray in rays:
-            ray_points = np.array(ray.history)
-            ax.plot(ray_points[:,0], ray_points[:,1], ray_points[:,2], color=ray.color)
+            if _is_passive(component):
+                continue
 
-        ax.view_init(elev=90, azim=30)
-        plt.show()
+            if isinstance(component, Propagator):
+                if plan and plan[-1][0] == "propagate" and not self.gravity:
+                    plan[-1] = ("propagate", plan[-1][1] + component.distance)
+                else:
+                    plan.append(("propagate", component.distance))
+                continue
 
-    def transform_points_to_global(self, points, position, rotation_matrix):
-        # Apply rotation
-        rotated_points = [rotation_matrix @ point for point in points]
-        # Apply translation
-        translated_points = [point + position for point in rotated_points]
-        return translated_points
+            # Global to local of this component after local to global of the frame
+            to_local = component.to_local_matrix
+            matrix = to_local @ frame_matrix
+            offset = to_local @ (frame_position - component.global_position)
+            if not (np.allclose(matrix, np.eye(3)) and np.allclose(offset, 0)):
+                plan.append(("transform", matrix, offset))
+            plan.append(("interact", component))
 
-    def transform_points_to_global(self, points, position, rotation_matrix):
-        # Apply rotation and translation
-        rotated_points = [rotation_matrix.apply(np.array(point)) for point in points]
-        translated_points = [point + position for point in rotated_points]
-        #translated_points = [point for point in rotated_points]
-        return translated_points
+            frame_matrix, frame_position = component.to_global_matrix, component.global_position
 
-    def visualize(self, rays, show_coordinates=False, ray_alpha=0.7, aspect=(2,1,1)):
-        fig = plt.figure(figsize=(8, 6))
-        ax = fig.add_subplot(111, projection='3d')
-        first_component = True
+        if not (np.allclose(frame_matrix, np.eye(3)) and np.allclose(frame_position, 0)):
+            plan.append(("transform", frame_matrix, frame_position))
 
+        self.plan = plan
+        self.plan_version = self.get_plan_version()
+        return plan
 
-        for component in self.components:
+    def get_plan_version(self):
+        # Changes whenever the plan from compile would be different
+        return bool(self.gravity), tuple(component.version for component in self.components)
 
-            local_points_list = component.get_visualization_points()
+    def run_batch(self, num_rays, record_history=False):
+        """
+        Trace all rays through the components at once
 
-            rotation_matrix = R.from_euler('xyz', component.global_rotation, degrees=True)
-            for local_points in local_points_list:
-                # Transform points to the global coordinate system
-                global_points = self.transform_points_to_global(local_points, component.global_position,
-                                                                rotation_matrix)
-
-                # print("global", global_points)
-                x, y, z = zip(*global_points)
-
-                # Use different order to get z horizontal
-                ax.plot(z, x, y, "-k")
-
-            if show_coordinates:
-                if isinstance(show_coordinates, float):
-                    clx = show_coordinates
-                    cly = show_coordinates
-                    clz = show_coordinates
-                elif isinstance(show_coordinates, list):
-                    clx = show_coordinates[0]
-                    cly = show_coordinates[1]
-                    clz = show_coordinates[2]
-                else:
-                    clx = 0.1
-                    cly = 0.1
-                    clz = 0.1
+        Returns a RayBatch with the final position, direction and weight of each
+        ray. With record_history the points of each ray are kept as well, and
+        RayBatch.to_rays gives rays that can be passed to visualize.
+
+        Without history the rays follow the plan from compile, with history they
+        go through every component so each one records its points.
+        """
+        gravity = [0, -9.81, 0] if self.gravity else None
+
+        if record_history:
+            rays = RayBatch.empty(num_rays, max_points=2 * len(self.components), gravity=gravity)
+            for component in self.components:
+                rays = self.transform_batch_to_local(rays, component)
+                rays = component.interact_batch(rays)
+                rays = self.transform_batch_to_global(rays, component)
+            return rays
+
+        if self.plan is None or self.plan_version != self.get_plan_version():
+            self.compile()
+
+        rays = RayBatch.empty(num_rays, gravity=gravity)
+        for step in self.plan:
+            if step[0] == "transform":
+                _, matrix, offset = step
+                rays.position = rays.position @ matrix.T + offset
+                rays.direction = rays.direction @ matrix.T
+                if rays.gravity is not None:
+                    rays.gravity = matrix @ rays.gravity
+            elif step[0] == "propagate":
+                rays.propagate(step[1])
+            else:
+                rays = step[1].interact_batch(rays)
+        return rays
 
-                local_coordinate_points = [([0,0,0], [clx,0,0]), ([0,0,0], [0,cly,0]), ([0,0,0], [0,0,clz])]
-                global_coordinate_points = self.transform_points_to_global(local_coordinate_points,
-                                                                           component.global_position,
-                                                                           rotation_matrix)
+    def run_streaming(self, num_rays, batch_size=100_000, num_trajectories=0):
+        """
+        Trace rays in batches of batch_size, keeping only the monitor tallies
+
+        Memory use is set by batch_size rather than num_rays. The first
+        num_trajectories rays are traced with history and returned as a list of
+        rays for visualize, they are an unbiased sample as all rays are
+        independent. All rays, including the sampled ones, reach the monitors.
+        """
+        num_trajectories = min(num_trajectories, num_rays)
+        trajectories = []
+        if num_trajectories > 0:
+            trajectories = self.run_batch(num_trajectories, record_history=True).to_rays()
+
+        remaining = num_rays - num_trajectories
+        while remaining > 0:
+            self.run_batch(min(batch_size, remaining))
+            remaining -= batch_size
+
+        return trajectories
+
+    def run_parallel(self, num_rays, processes=None, batch_size=100_000, seed=None):
+        """
+        Split num_rays over a pool of processes and merge the monitor tallies
+
+        Each process traces its share of the rays on a copy of the simulator with
+        its own random stream spawned from seed, so the shards are independent
+        and a run with a given seed and number of processes is reproducible.
+        """
+        if processes is None:
+            processes = os.cpu_count()
+
+        # The first shards take one ray more when num_rays does not divide evenly
+        size, remainder = divmod(num_rays, processes)
+        shard_sizes = [size + 1] * remainder + [size] * (processes - remainder)
+        seed_sequences = np.random.SeedSequence(seed).spawn(processes)
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = executor.map(_run_shard, [self] * processes, shard_sizes,
+                                   [batch_size] * processes, seed_sequences)
+
+            monitors = [component for component in self.components if component.is_monitor]
+            for shard_tallies in results:
+                for monitor, tallies in zip(monitors, shard_tallies):
+                    monitor.add_tallies(tallies)
 
-                if first_component:
-                    x, y, z = zip(*global_coordinate_points[0])
-                    ax.plot(z, x, y, "-r", label="x")
+    def transform_points_to_global(self, points, position, rotation_matrix):
+        # Points can have any shape (..., 3), all are transformed in one matmul
+        return np.asarray(points, dtype=float) @ rotation_matrix.T + position
+
+    def get_trajectories(self, rays, max_rays=None):
+        """
+        Trajectories of a list of rays or a RayBatch with history as line segments
+
+        Returns a list of (num_points, 3) arrays in global coordinates and the
+        color of each. If there are more than max_rays rays, an evenly spaced
+        subset of max_rays of them is returned.
+        """
+        if isinstance(rays, RayBatch):
+            if rays.history is None:
+                raise ValueError("No history recorded, use run_batch with record_history=True")
+            selected = np.flatnonzero(rays.num_points > 0)
+        else:
+            selected = np.arange(len(rays))
 
-                    x, y, z = zip(*global_coordinate_points[1])
-                    ax.plot(z, x, y, "-g", label="y")
+        if max_rays is not None and len(selected) > max_rays:
+            selected = selected[np.linspace(0, len(selected) - 1, max_rays).astype(int)]
 
-                    x, y, z = zip(*global_coordinate_points[2])
-                    ax.plot(z, x, y, "-b", label="z")
+        if isinstance(rays, RayBatch):
+            # Pad shorter trajectories by repeating their last point, giving one array
+            num_points = rays.num_points[selected]
+            point_index = np.minimum(np.arange(num_points.max(initial=0)), num_points[:, np.newaxis] - 1)
+            segments = rays.history[selected[:, np.newaxis], point_index]
+            return list(segments), ['gray'] * len(selected)
 
-                    first_component = False
-                else:
-                    x, y, z = zip(*global_coordinate_points[0])
-                    ax.plot(z, x, y, "-r")
+        return [rays[index].history for index in selected], [rays[index].color for index in selected]
 
-                    x, y, z = zip(*global_coordinate_points[1])
-                    ax.plot(z, x, y, "-g")
+    def visualize(self, rays, show_coordinates=False, ray_alpha=0.7, aspect=(2,1,1), max_rays=1000):
+        """
+        Plot the components, the rays and the 2D monitor results in 3D
 
-                    x, y, z = zip(*global_coordinate_points[2])
-                    ax.plot(z, x, y, "-b")
+        rays is a list of rays or a RayBatch with history. At most max_rays of
+        them are drawn, all in a single line collection. Use None to draw all.
+        The axes are ordered so the beam (z) direction is horizontal.
+        """
+        fig = plt.figure(figsize=(8, 6))
+        ax = fig.add_subplot(111, projection='3d')
 
-        for ray in rays:
-            ray_points = np.array(ray.history)
-            ax.plot(ray_points[:,2], ray_points[:,0], ray_points[:,1], color=ray.color, alpha=ray_alpha)
+        # Use different order to get z horizontal
+        plot_order = [2, 0, 1]
 
+        outlines = []
+        for component in self.components:
+            for local_points in component.get_visualization_points():
+                global_points = self.transform_points_to_global(local_points, component.global_position,
+                                                                component.to_global_matrix)
+                outlines.append(global_points[:, plot_order])
+        ax.add_collection3d(Line3DCollection(outlines, colors='k'))
 
-        if component.is_monitor:
-            # This is a monitor, try to show result
-            #component.show_data(ax)
+        if show_coordinates:
+            if isinstance(show_coordinates, float):
+                lengths = [show_coordinates] * 3
+            elif isinstance(show_coordinates, list):
+                lengths = show_coordinates
+            else:
+                lengths = [0.1, 0.1, 0.1]
+
+            # Axis ends of every component in one array of shape (components, 3 axes, 3)
+            axis_ends = np.stack([self.transform_points_to_global(np.diag(lengths), component.global_position,
+                                                                  component.to_global_matrix)
+                                  for component in self.components])
+            origins = np.stack([component.global_position for component in self.components])
+
+            for axis, (color, label) in enumerate(zip("rgb", "xyz")):
+                lines = np.stack((origins, axis_ends[:, axis]), axis=1)[:, :, plot_order]
+                ax.add_collection3d(Line3DCollection(lines, colors=color, label=label))
+
+        segments, colors = self.get_trajectories(rays, max_rays)
+        segments = [segment[:, plot_order] for segment in segments]
+        ax.add_collection3d(Line3DCollection(segments, colors=colors, alpha=ray_alpha))
 
+        for component in self.components:
+            if not (component.is_monitor and component.intensity.ndim == 2):
+                continue
+            if component.counts.sum() == 0:
+                continue
 
+            # Show the monitor result on its surface
             x, y = component.get_axis_1D()
             X, Y = np.meshgrid(x, y)
-            Z = np.zeros(X.shape)
-
-            X_flat = X.flatten()
-            Y_flat = Y.flatten()
-            Z_flat = Z.flatten()
-
-            coordinates = []
-            for index in range(len(X_flat)):
-                coordinates.append(np.array([X_flat[index], X_flat[index], Z_flat[index]]))
-
-            rotation_matrix = R.from_euler('xyz', component.global_rotation, degrees=True)
-            global_coordinates = self.transform_points_to_global(coordinates, component.global_position, rotation_matrix)
-
-            X_flat_global = np.zeros(X_flat.shape)
-            Y_flat_global = np.zeros(Y_flat.shape)
-            Z_flat_global = np.zeros(Z_flat.shape)
-            for index in range(len(global_coordinates)):
-                X_flat_global[index] = global_coordinates[index][0]
-                Y_flat_global[index] = global_coordinates[index][1]
-                Z_flat_global[index] = global_coordinates[index][2]
-
-            X_global = X_flat_global.reshape(X.shape)
-            Y_global = Y_flat_global.reshape(Y.shape)
-            Y_global = Y_global.T
-            Z_global = Z_flat_global.reshape(Z.shape)
-
-            if component.counts.sum() > 0:
-                color_value = component.intensity/np.max(np.max(component.intensity))
-                my_col = cm.winter(color_value.T)
-                surf = ax.plot_surface(Z_global, X_global, Y_global, rstride=1, cstride=1,
-                                       facecolors=my_col, linewidth=0, antialiased=False, shade=False)
+            local_points = np.stack((X, Y, np.zeros(X.shape)), axis=-1)
+            global_points = self.transform_points_to_global(local_points, component.global_position,
+                                                            component.to_global_matrix)
+
+            color_value = component.intensity/np.max(component.intensity)
+            my_col = cm.winter(color_value.T)
+            ax.plot_surface(*(global_points[..., axis] for axis in plot_order), rstride=1, cstride=1,
+                            facecolors=my_col, linewidth=0, antialiased=False, shade=False)
+
+        # Collections do not update the axis limits, set them from the geometry and rays
+        all_points = np.concatenate([np.zeros((0, 3))] + outlines + segments)
+        for set_limits, low, high in zip((ax.set_xlim, ax.set_ylim, ax.set_zlim),
+                                         all_points.min(axis=0), all_points.max(axis=0)):
+            margin = 0.05 * (high - low) if high > low else 0.5
+            set_limits(low - margin, high + margin)
 
         ax.set_xlabel("z [m]")
         ax.set_ylabel("x [m]")
@@ -0,0 +1,148 @@
+"""
+Benchmarks for the ess-pipeline stages and the simple_simulator ray tracer
+
+Each benchmark is timed as the best of a few repeats after an untimed warm-up
+call. Results can be saved as a baseline and later runs compared against it:
+
+    python benchmarks/run_benchmarks.py --save benchmarks/results/baseline.json
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/baseline.json
+"""
+import argparse
+import json
+import os
+import pathlib
+import platform
+import sys
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")  # The detector stage creates a figure
+
+repository = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.append(os.fspath(repository / "1-python" / "ess-pipeline"))
+sys.path.append(os.fspath(repository / "3-mcstas"))
+
+import numpy as np
+
+from detector import record_events
+from guide import transport
+from sample import interact_with_sample
+from source import accelerate, make_protons
+from target import make_neutrons
+import ray_tracer_examples
+
+
+def best_time(function, repeat):
+    # One untimed call first, so Numba compilation and first-use caches are not timed
+    function()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def pipeline_benchmarks(sizes, repeat):
+    results = {}
+    for n in sizes:
+        print(f"ess-pipeline, {n} events", flush=True)
+
+        # Every stage gets n events as input, so probability=1 in the target
+        protons = accelerate(make_protons(n, rng=1))
+        neutrons = make_neutrons(protons, probability=1.0, rng=2)
+
+        stages = {
+            "source_and_accelerator": lambda: accelerate(make_protons(n, rng=1)),
+            "target": lambda: make_neutrons(protons, rng=2),
+            "neutron_guide": lambda: transport(neutrons, rng=3),
+            "sample": lambda: interact_with_sample(neutrons, rng=4),
+            "detector": lambda: record_events(neutrons),
+        }
+        for name, stage in stages.items():
+            results[f"pipeline.{name}[{n}]"] = best_time(stage, repeat)
+
+        del protons, neutrons
+
+    return results
+
+
+def simulator_benchmarks(ray_counts, per_ray_counts, repeat):
+    results = {}
+    for example in ("guide", "large"):
+        sim = getattr(ray_tracer_examples, example)()
+        sim.set_seed(1)
+
+        for n in per_ray_counts:
+            print(f"simple_simulator {example}, run, {n} rays", flush=True)
+            results[f"simulator.{example}.run[{n}]"] = best_time(lambda: sim.run(n), repeat)
+
+        for n in ray_counts:
+            print(f"simple_simulator {example}, run_batch, {n} rays", flush=True)
+            results[f"simulator.{example}.run_batch[{n}]"] = best_time(
+                lambda: sim.run_batch(n), repeat
+            )
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print a table comparing results with a baseline, return the number of regressions."""
+    print(f"\n{'benchmark':<50}{'baseline [s]':>14}{'current [s]':>14}{'ratio':>8}")
+    regressions = 0
+    for name, current in results.items():
+        if name not in baseline:
+            print(f"{name:<50}{'-':>14}{current:>14.4g}{'-':>8}")
+            continue
+
+        ratio = current / baseline[name]
+        flag = ""
+        if ratio > threshold:
+            flag = "  slower"
+            regressions += 1
+        elif ratio < 1 / threshold:
+            flag = "  faster"
+        print(f"{name:<50}{baseline[name]:>14.4g}{current:>14.4g}{ratio:>8.2f}{flag}")
+
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="Time the ess-pipeline stages and simple_simulator")
+parser.add_argument("--sizes", type=int, nargs="+", default=[10**4, 10**5, 10**6, 10**7],
+                    help="Number of events for the ess-pipeline stages")
+parser.add_argument("--rays", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6],
+                    help="Number of rays for Simulator.run_batch")
+parser.add_argument("--per-ray", type=int, nargs="*", default=[100, 1000],
+                    help="Number of rays for the per-ray Simulator.run")
+parser.add_argument("--repeat", type=int, default=3, help="Repeats per benchmark, the best is kept")
+parser.add_argument("--save", type=str, help="Save the results as a baseline to this file")
+parser.add_argument("--compare", type=str, help="Compare the results with this baseline file")
+parser.add_argument("--threshold", type=float, default=1.2,
+                    help="Ratio to the baseline that counts as a regression")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    results = pipeline_benchmarks(args.sizes, args.repeat)
+    results.update(simulator_benchmarks(args.rays, args.per_ray, args.repeat))
+
+    if args.save:
+        pathlib.Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"machine": platform.node(),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "results": results}, f, indent=2)
+        print(f"Saved results to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    if not args.save:
+        for name, value in results.items():
+            print(f"{name:<50}{value:>14.4g}")
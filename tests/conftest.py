@@ -0,0 +1,11 @@
+import os
+import pathlib
+import sys
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+repository = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.append(os.fspath(repository / "1-python" / "ess-pipeline"))
+sys.path.append(os.fspath(repository / "3-mcstas"))
@@ -0,0 +1,79 @@
+import functools
+
+import numpy as np
+import pytest
+
+import physics
+from cache import cache_key, cached
+from guide import transport
+from neutron_batch import NeutronBatch
+
+
+@pytest.fixture
+def neutrons():
+    batch = NeutronBatch(1000)
+    batch["vz"] = 1.0
+    batch["energy"] = 25.0
+    return batch
+
+
+def test_same_inputs_give_the_same_key(neutrons):
+    def key(factor):
+        return cache_key(transport, (neutrons,), {"rng": 1, "transmission": lambda n: factor})
+
+    assert key(0.5) == key(0.5)
+
+
+def test_changed_constants_give_a_new_key(neutrons):
+    first = cache_key(transport, (neutrons,), {"transmission": lambda n: np.full(n.n_events, 0.1)})
+    second = cache_key(transport, (neutrons,), {"transmission": lambda n: np.full(n.n_events, 0.9)})
+    assert first != second
+
+    def closure(value):
+        return lambda n: value
+
+    assert cache_key(transport, (neutrons,), {"transmission": closure(0.1)}) != cache_key(
+        transport, (neutrons,), {"transmission": closure(0.9)}
+    )
+
+
+def test_cached_stage_reruns_for_changed_function(neutrons, tmp_path):
+    stage = cached(transport, cache_dir=tmp_path)
+
+    low = stage(neutrons, rng=1, transmission=lambda n: np.full(n.n_events, 0.1))
+    high = stage(neutrons, rng=1, transmission=lambda n: np.full(n.n_events, 0.9))
+    again = stage(neutrons, rng=1, transmission=lambda n: np.full(n.n_events, 0.9))
+
+    assert low.n_events < 200 < 800 < high.n_events
+    np.testing.assert_array_equal(again.data, high.data)
+
+
+class Transmission:
+    def __call__(self, neutrons):
+        return 0.5
+
+
+@pytest.mark.parametrize(
+    "transmission", [Transmission(), functools.partial(Transmission()), np.random.default_rng(1)]
+)
+def test_unsupported_arguments_run_uncached(neutrons, tmp_path, transmission):
+    if callable(transmission):
+        kwargs = {"rng": 1, "transmission": transmission}
+    else:
+        kwargs = {"rng": transmission}
+
+    with pytest.raises(TypeError):
+        cache_key(transport, (neutrons,), kwargs)
+
+    result = cached(transport, cache_dir=tmp_path)(neutrons, **kwargs)
+    assert 0 < result.n_events < neutrons.n_events
+    assert not list(tmp_path.iterdir())
+
+
+def test_physics_models_are_keyed_on_their_parameters(neutrons):
+    def key(model):
+        return cache_key(transport, (neutrons,), {"transmission": model})
+
+    assert key(physics.supermirror(m=2)) == key(physics.supermirror(m=2))
+    assert key(physics.supermirror(m=2)) != key(physics.supermirror(m=3))
+    assert key(physics.beer_lambert(thickness=1)) != key(physics.beer_lambert(thickness=2))
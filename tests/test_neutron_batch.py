@@ -0,0 +1,60 @@
+import numpy as np
+
+from neutron_batch import COLUMNS, NeutronBatch
+
+
+def make_batch():
+    batch = NeutronBatch(5)
+    batch["x"] = np.arange(5.0)
+    return batch
+
+
+def test_from_dict():
+    batch = NeutronBatch.from_dict({"x": [1.0, 2.0], "energy": [3.0, 4.0], "message": "hi"})
+
+    assert batch.columns == COLUMNS
+    assert batch.n_events == 2
+    np.testing.assert_array_equal(batch["x"], [1, 2])
+    np.testing.assert_array_equal(batch["energy"], [3, 4])
+    np.testing.assert_array_equal(batch["y"], [0, 0])
+    np.testing.assert_array_equal(batch["weight"], [1, 1])
+    assert batch["message"] == "hi"
+    assert NeutronBatch.from_dict(batch) is batch
+
+
+def test_select_shares_the_array():
+    batch = make_batch()
+    selected = batch.select(batch["x"] > 2)
+
+    assert selected.n_events == 2
+    np.testing.assert_array_equal(selected["x"], [3, 4])
+    np.testing.assert_array_equal(selected.select([False, True])["x"], [4])
+
+    batch["x"] = np.arange(10.0, 15.0)
+    np.testing.assert_array_equal(selected["x"], [13, 14])
+
+
+def test_setitem_on_selection_leaves_the_parent():
+    batch = make_batch()
+    selected = batch.select(batch["x"] > 2)
+    selected["x"] = [30.0, 40.0]
+
+    np.testing.assert_array_equal(selected["x"], [30, 40])
+    np.testing.assert_array_equal(batch["x"], [0, 1, 2, 3, 4])
+
+
+def test_compact():
+    batch = make_batch()
+    batch.compact(batch["x"] % 2 == 0)
+
+    assert batch.n_events == 3
+    np.testing.assert_array_equal(batch["x"], [0, 2, 4])
+    np.testing.assert_array_equal(batch["weight"], [1, 1, 1])
+
+
+def test_compact_selection_leaves_the_parent():
+    batch = make_batch()
+    selected = batch.select(batch["x"] > 1).compact([True, False, True])
+
+    np.testing.assert_array_equal(selected["x"], [2, 4])
+    np.testing.assert_array_equal(batch["x"], [0, 1, 2, 3, 4])
@@ -0,0 +1,21 @@
+import numpy as np
+
+import physics
+from parallel import run_stage_parallel
+from sample import interact_with_sample
+from source import make_protons
+from target import make_neutrons
+
+
+def test_physics_model_in_parallel_stage():
+    neutrons = make_neutrons(make_protons(20_000, rng=1), probability=1.0, rng=2)
+    kwargs = {
+        "transmission": physics.beer_lambert(thickness=0.5),
+        "scattering": physics.bragg_scattering(),
+    }
+
+    result = run_stage_parallel(interact_with_sample, neutrons, processes=2, seed=3, **kwargs)
+    again = run_stage_parallel(interact_with_sample, neutrons, processes=2, seed=3, **kwargs)
+
+    assert 0 < result.n_events < neutrons.n_events
+    np.testing.assert_array_equal(result.data, again.data)
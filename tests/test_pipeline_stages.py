@@ -0,0 +1,38 @@
+import numpy as np
+
+import physics
+from guide import transport
+from neutron_batch import NeutronBatch
+from sample import interact_with_sample
+from source import make_protons
+from target import make_neutrons
+
+
+def test_guide_time_of_flight():
+    neutrons = NeutronBatch(2)
+    neutrons["vx"] = [0, 0.6]
+    neutrons["vz"] = [1, 0.8]
+    neutrons["energy"] = 25.3  # meV, about 2200 m/s
+
+    out = transport(neutrons, guide_length=10, transmission=1)
+
+    speed = 437.4 * np.sqrt(25.3)
+    np.testing.assert_allclose(out["time"], [10 / speed, 10 / (0.8 * speed)])
+    np.testing.assert_allclose(out["z"], 10)
+
+
+def test_weighted_sample_conserves_weight():
+    neutrons = make_neutrons(make_protons(1000, rng=1), probability=1.0, rng=2)
+    neutrons["weight"] = np.linspace(0.5, 1.5, neutrons.n_events)
+
+    out = interact_with_sample(
+        neutrons,
+        rng=3,
+        transmission=physics.flat(0.7),
+        scattering=physics.isotropic_scattering(),
+        weighted=True,
+    )
+
+    assert out.n_events == 2 * neutrons.n_events
+    np.testing.assert_allclose(out["weight"].sum(), neutrons["weight"].sum())
+    np.testing.assert_allclose(out["weight"][: neutrons.n_events], 0.7 * neutrons["weight"])
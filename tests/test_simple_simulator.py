@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+
+import ray_tracer_examples
+import simple_simulator
+from simple_simulator import kernels
+
+
+def guide_with_1d_monitors():
+    sim = ray_tracer_examples.guide()
+    sim.add_component("DivergenceMonitor", width=0.08, height=0.08, position=[0, 0, 5.1])
+    sim.add_component("WavelengthMonitor", width=0.08, height=0.08, position=[0, 0, 5.2])
+    return sim
+
+
+@pytest.fixture
+def restore_backend():
+    backend = kernels.backend
+    yield
+    kernels.use_backend(backend)
+
+
+def run_example(make_simulator, backend, num_rays=20_000):
+    kernels.use_backend(backend)
+    sim = make_simulator()
+    sim.set_seed(1)
+    sim.run_batch(num_rays)
+    return [component for component in sim.components if component.is_monitor]
+
+
+@pytest.mark.parametrize("make_simulator", [ray_tracer_examples.guide, ray_tracer_examples.large,
+                                            guide_with_1d_monitors])
+def test_numba_backend_matches_numpy(make_simulator, restore_backend):
+    pytest.importorskip("numba")
+
+    expected = run_example(make_simulator, "numpy")
+    result = run_example(make_simulator, "numba")
+
+    for monitor, reference in zip(result, expected):
+        assert monitor.counts.sum() > 0
+        np.testing.assert_array_equal(monitor.counts, reference.counts)
+        np.testing.assert_allclose(monitor.intensity, reference.intensity)
+        np.testing.assert_allclose(monitor.intensity_squared, reference.intensity_squared)
+
+
+@pytest.mark.parametrize("method", ["run", "run_batch"])
+def test_time_of_flight_and_wavelength(method):
+    sim = simple_simulator.Simulator()
+    sim.add_component("Source", width=0.01, height=0.01, angle_spread=0, wavelength=4)
+    sim.add_component("Propagator", distance=5)
+    tof = sim.add_component("TOFMonitor", width=0.1, height=0.1, position=[0, 0, 10],
+                            bins=100, limits=(0, 2e4))
+    wavelength = sim.add_component("WavelengthMonitor", width=0.1, height=0.1, position=[0, 0, 10.1],
+                                   bins=10, limits=(0, 10))
+    sim.set_seed(1)
+    getattr(sim, method)(100)
+
+    # 10 m at the speed of 4 Å neutrons
+    expected_tof = 10 / (simple_simulator.ray.WAVELENGTH_SPEED / 4) * 1e6
+    assert tof.counts[int(expected_tof // 200)] == 100
+    assert wavelength.counts[4] == 100
+
+
+def test_run_keeps_components_overriding_interact():
+    class Absorber(simple_simulator.component.Component):
+        def interact(self, ray):
+            ray.weight = 0
+            return ray
+
+    sim = simple_simulator.Simulator()
+    sim.add_component("Source", width=0.01, height=0.01, angle_spread=0)
+    sim.include_component(Absorber(position=[0, 0, 0.5]))
+    monitor = sim.add_component("Monitor", width=0.1, height=0.1, position=[0, 0, 1])
+    sim.run(10)
+
+    assert monitor.counts.sum() == 10
+    assert monitor.intensity.sum() == 0
+
+
+def test_compiled_plan_matches_component_walk():
+    sim = simple_simulator.Simulator()
+    sim.add_component("Source", width=0.05, height=0.05, angle_spread=1)
+    arm = sim.add_component("Arm", position=[0, 0, 0.5], rotation=[5, 10, 0])
+    sim.add_component("Propagator", distance=0.5, relative=arm)
+    sim.add_component("Monitor", width=0.2, height=0.2, position=[0, 0, 2])
+
+    sim.set_seed(1)
+    walked = sim.run_batch(1000, record_history=True)
+    sim.set_seed(1)
+    compiled = sim.run_batch(1000)
+
+    np.testing.assert_allclose(compiled.position, walked.position, atol=1e-12)
+    np.testing.assert_allclose(compiled.direction, walked.direction, atol=1e-12)
+
+
+def test_tube_unfold_matches_iterative_reflections():
+    tube = simple_simulator.component.RectangularTube(width=0.07, height=0.05, length=4)
+    rng = np.random.default_rng(1)
+    num_rays = 20_000
+
+    # Forward rays entering through the opening
+    position = np.column_stack((rng.uniform(-0.035, 0.035, num_rays),
+                                rng.uniform(-0.025, 0.025, num_rays),
+                                np.zeros(num_rays)))
+    direction = np.column_stack((rng.normal(0, 0.02, num_rays),
+                                 rng.normal(0, 0.02, num_rays),
+                                 np.ones(num_rays)))
+    direction /= np.linalg.norm(direction, axis=1)[:, np.newaxis]
+    speed = rng.uniform(400, 4000, num_rays)
+
+    unfolded = simple_simulator.ray.RayBatch(position, direction, speed=speed)
+    tube.interact_batch(unfolded)
+    _, _, num_reflections = tube.unfold(position, direction)
+
+    iterative = simple_simulator.ray.RayBatch(position, direction, speed=speed, max_points=1)
+    tube.interact_batch_iterative(iterative)
+
+    assert num_reflections.max() > 1
+    np.testing.assert_array_equal(num_reflections, iterative.num_points)
+    np.testing.assert_allclose(unfolded.position, iterative.position, atol=1e-12)
+    np.testing.assert_allclose(unfolded.direction, iterative.direction, atol=1e-12)
+    np.testing.assert_allclose(unfolded.time, iterative.time, rtol=1e-12)
+
+
+def test_plan_follows_moved_components_and_gravity():
+    sim = simple_simulator.Simulator()
+    sim.add_component("Source", width=0.05, height=0.05, angle_spread=1)
+    monitor = sim.add_component("Monitor", width=0.2, height=0.2, position=[0, 0, 2])
+    sim.run_batch(10)
+
+    def compare():
+        sim.set_seed(1)
+        walked = sim.run_batch(100, record_history=True)
+        sim.set_seed(1)
+        compiled = sim.run_batch(100)
+        np.testing.assert_allclose(compiled.position, walked.position, atol=1e-12)
+        np.testing.assert_allclose(compiled.time, walked.time, rtol=1e-12)
+
+    monitor.set_global_coordinates(np.zeros(3), np.array([0, 10, 0]))
+    compare()
+    sim.gravity = True
+    compare()